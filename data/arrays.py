@@ -0,0 +1,165 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from units import (
+    Dimension,
+    Quantity,
+    Units,
+    ConversionMap,
+    conversion_table,
+)
+from value import Value
+
+
+def scientific_array(values: np.ndarray) -> np.ndarray:
+    """units.scientific(value) of every value, as bytes"""
+    values = np.asarray(values, dtype=np.float64)
+    if not np.all(np.isfinite(values)):
+        raise ValueError("Only finite quantities can be written")
+    rows = np.arange(len(values))
+    # numpy writes the shortest digits that read back as each value, like
+    # repr, as in 1234.5, 0.0012 or 1e-05, so only the point has to move
+    chars = np.abs(values).astype("S24").view(np.uint8).reshape(-1, 24)
+    columns = np.arange(chars.shape[1])
+    length = (chars != 0).sum(axis=1)
+    is_e = chars == ord("e")
+    e_at = np.where(is_e.any(axis=1), is_e.argmax(axis=1), length)
+    is_point = chars == ord(".")
+    point_at = np.where(is_point.any(axis=1), is_point.argmax(axis=1), e_at)
+    is_digit = (chars >= ord("0")) & (chars <= ord("9"))
+
+    in_exponent = is_digit & (columns > e_at[:, None])
+    places = (length[:, None] - 1 - columns).clip(0)
+    places = np.where(in_exponent, 10**places, 0)
+    exponents = ((chars.astype(np.int64) - ord("0")) * places).sum(axis=1)
+    after_e = np.minimum(e_at + 1, chars.shape[1] - 1)
+    exponents[chars[rows, after_e] == ord("-")] *= -1
+
+    in_mantissa = is_digit & (columns < e_at[:, None])
+    significant = in_mantissa & (chars != ord("0"))
+    first = significant.argmax(axis=1)
+    last = chars.shape[1] - 1 - significant[:, ::-1].argmax(axis=1)
+    # zeros before the first significant digit, as in 0.0012
+    leading = first - (first > point_at)
+    magnitudes = point_at - 1 - leading + exponents
+    kept = in_mantissa & (columns >= first[:, None]) & (columns <= last[:, None])
+
+    # the sign, the first digit, the point, the other digits (or 0), e and
+    # the magnitude, with each row's digits moved to where they go
+    sign = (values < 0).astype(int)
+    count = kept.sum(axis=1)
+    written = np.zeros((len(values), chars.shape[1] + 8), dtype=np.uint8)
+    written[rows, 0] = np.where(values < 0, ord("-"), 0)
+    to = sign[:, None] + np.cumsum(kept, axis=1) - 1
+    to += to > sign[:, None]
+    written[np.nonzero(kept)[0], to[kept]] = chars[kept]
+    written[rows, sign + 1] = ord(".")
+    written[rows[count < 2], sign[count < 2] + 2] = ord("0")
+    e_to = sign + 2 + np.maximum(count - 1, 1)
+    written[rows, e_to] = ord("e")
+    magnitude_chars = magnitudes.astype("S5").view(np.uint8).reshape(-1, 5)
+    written[rows[:, None], e_to[:, None] + 1 + np.arange(5)] = magnitude_chars
+    written = written.view(f"S{written.shape[1]}").ravel()
+    return np.where(values == 0, b"0.0e0", written)
+
+
+@dataclass
+class QuantityArray:
+    """Many magnitudes sharing one set of units"""
+
+    values: np.ndarray
+    units: Units
+
+    def __post_init__(self):
+        self.values = np.asarray(self.values, dtype=np.float64)
+
+    @staticmethod
+    def from_quantities(quantities: Iterable[Quantity]):
+        quantities = list(quantities)
+        if not quantities:
+            return QuantityArray(np.empty(0), Units([]))
+        units = quantities[0].units
+        for quantity in quantities:
+            if quantity.units.dimension != units.dimension:
+                raise ValueError(
+                    f"Cannot combine '{quantity.units}' and '{units}' in one array"
+                )
+        return QuantityArray([quantity.value for quantity in quantities], units)
+
+    def quantities(self) -> List[Quantity]:
+        return [Quantity(value, self.units) for value in self.values.tolist()]
+
+    def standardized(self, map: ConversionMap, limit=100):
+        values, units = conversion_table(map, limit).convert(self.values, self.units)
+        return QuantityArray(values, units)
+
+    def to_string(self, precision=None) -> List[str]:
+        """The same strings as Quantity.to_string for every element"""
+        units = str(self.units)
+        if precision is None:
+            nums = scientific_array(self.values).astype(str).tolist()
+            return [f"{num} {units}".strip() for num in nums]
+        if np.any(self.values <= 0):
+            raise ValueError("Only positive quantities can be rounded")
+        magnitudes = np.floor(np.log10(self.values)).astype(int)
+        # powers of ten computed like units.scientific so the digits match
+        magnitudes = magnitudes.tolist()
+        # as floats, since tiny magnitudes need scales too big for an int64
+        scales = {m: float(10 ** (precision - m - 1)) for m in set(magnitudes)}
+        nums = self.values * np.array([scales[m] for m in magnitudes])
+        nums = np.round(nums) / 10 ** (precision - 1)
+        return [
+            f"{num}e{magnitude} {units}".strip()
+            for num, magnitude in zip(nums.tolist(), magnitudes)
+        ]
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return Quantity(float(self.values[index]), self.units)
+        return QuantityArray(self.values[index], self.units)
+
+    def __mul__(self, other):
+        if type(other) == QuantityArray:
+            return QuantityArray(self.values * other.values, self.units * other.units)
+        if type(other) == Quantity:
+            return QuantityArray(self.values * other.value, self.units * other.units)
+        return QuantityArray(self.values * other, self.units)
+
+    def __rmul__(self, other):
+        return self.__mul__(other)
+
+    def __truediv__(self, other):
+        if type(other) in (QuantityArray, Quantity):
+            return self * other**-1
+        return QuantityArray(self.values / other, self.units)
+
+    def __rtruediv__(self, other):
+        return other * self**-1
+
+    def __pow__(self, power):
+        return QuantityArray(self.values**power, self.units**power)
+
+
+def group_values(
+    values: List[Value], by: Callable[[Value], object] = None
+) -> Dict[Dimension | Tuple, Tuple[List[Value], QuantityArray]]:
+    """
+    Group values into arrays by their units, and optionally also by some
+    other key, ie lambda value: value.measurement
+    """
+    groups: Dict[Dimension | Tuple, List[Value]] = {}
+    for value in values:
+        key = value.value.units.dimension
+        if by:
+            key = (by(value), key)
+        groups.setdefault(key, []).append(value)
+    return {
+        key: (group, QuantityArray.from_quantities(value.value for value in group))
+        for key, group in groups.items()
+    }
@@ -0,0 +1,244 @@
+from __future__ import annotations
+from contextlib import redirect_stdout
+import io
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+import click
+
+import clean
+import generate
+import units
+from data import now
+from images import ImageCache, cached_image_search_all
+from natural_language import CompletionContext, create_names
+from question import Question
+from value import Value
+
+# Units to write each measurement in, from plain to prefixed, imperial and
+# compound ones
+UNITS = {
+    "volume": ["m3", "km3", "L", "mL", "gal", "ft3", "in3"],
+    "surface area": ["m2", "km2", "cm2", "ft2", "mile2"],
+    "length": ["m", "km", "mm", "nm", "in", "ft", "mile", "ly"],
+    "mass": ["g", "kg", "Mg", "mg", "lb", "oz"],
+    "time/age": ["s", "ms", "hour", "day", "year", "yr"],
+    "count": [""],
+    "speed": ["m/s", "km/h", "mph", "ft/s"],
+    "temperature": ["K", "C", "F"],
+    "density": ["kg/m3", "g/cm3", "lb/ft3"],
+    "frequency": ["Hz", "MHz", "GHz", "/s"],
+    "energy": ["J", "kJ", "eV", "kWh", "Wh"],
+    "power": ["W", "kW", "MW", "hp"],
+    "loudness": ["dB"],
+    "charge": ["C"],
+    "other": ["psi", "m/s2", "J/g"],
+}
+SPECIFIERS = ["", "", "", "min", "max", "diameter", "r", "avg", "peak"]
+TAGS = ["", "", "sphere", "radiation", "country", "building", "animal"]
+BROKEN = ["about a lot", "1-2 m", "0 kg", "?", "12 (citation needed"]
+
+
+def synthetic_sheet(rows: int, seed=0, broken=0.03) -> str:
+    """A sheet like the curated one, the same for the same rows and seed"""
+    rng = random.Random(seed)
+    measurements = clean.COLUMNS[1:-2]
+    lines = ["\t".join(clean.COLUMNS)]
+    for i in range(rows):
+        tag = rng.choice(TAGS)
+        cells = {"thing": f"Thing {i}", "tags": tag}
+        if rng.random() < 0.2:
+            cells["sources"] = f"image: Thing {i}"
+        for measurement in rng.sample(measurements, rng.randint(1, 5)):
+            fragments = []
+            for _ in range(rng.choice([1, 1, 1, 2])):
+                if rng.random() < broken:
+                    fragments.append(rng.choice(BROKEN))
+                    continue
+                specifier = rng.choice(SPECIFIERS)
+                number = f"{rng.uniform(1, 10):.3g}e{rng.randint(-12, 15)}"
+                unit = rng.choice(UNITS[measurement])
+                fragment = f"{number} {unit}".strip()
+                fragments.append(f"{specifier}: {fragment}" if specifier else fragment)
+            cells[measurement] = ", ".join(fragments)
+        lines.append("\t".join(cells.get(column, "") for column in clean.COLUMNS))
+    return "\n".join(lines) + "\n"
+
+
+class FakeCompletionContext(CompletionContext):
+    """Names values without leaving the machine"""
+
+    def complete(self, messages: List[dict]):
+        thing = messages[-1]["content"].partition("\n")[0].removeprefix("thing: ")
+        return f"The value of {thing}"
+
+
+class FakeSearcher:
+    """An ImageSearcher that finds an image for most things, instantly"""
+
+    def search_all(self, things: List[str]):
+        return {
+            thing: "" if len(thing) % 10 == 0 else f"https://example.org/{thing}.jpg"
+            for thing in things
+        }
+
+
+def timed(times: Dict[str, float], stage: str, fn: Callable, *args, **kwargs):
+    """Run fn, adding its wall time to times[stage] and hiding its output"""
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        result = fn(*args, **kwargs)
+    times[stage] = time.perf_counter() - start
+    return result
+
+
+def allocated(fn: Callable):
+    """What fn returns, and the bytes it still holds on to"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = fn()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+def run(rows: int, seed=0, questions=1000, exhaustive_rows=10000):
+    """
+    Time each stage of the pipeline on a synthetic sheet of rows rows.
+    exhaustive_questions compares every pair of values, so it is only timed
+    up to exhaustive_rows rows.
+    """
+    sheet = synthetic_sheet(rows, seed)
+    times: Dict[str, float] = {}
+    df = timed(times, "read", clean.read_frame, io.StringIO(sheet))
+
+    fragments = [
+        fragment.strip()
+        for cell in df[clean.COLUMNS[1:-2]].stack()
+        for fragment in cell.split(",")
+    ]
+    matches = [clean.value_regex.match(fragment) for fragment in fragments]
+    strings = [f"{m.group(2)} {m.group(3)}" for m in matches if m]
+    units.parse_units.cache_clear()
+    quantities = timed(
+        times,
+        "from_str",
+        lambda: [units.Quantity.from_str(string) for string in strings],
+    )
+    timed(
+        times,
+        "standardized",
+        lambda: [quantity.standardized(units.preferred) for quantity in quantities],
+    )
+
+    things = timed(times, "get_things", clean.get_things, df)
+    timed(times, "alter", clean.alter_things, things)
+    values = [value for thing in things for value in clean.thing_values(thing)]
+
+    random.seed(seed)
+    timed(times, "naming", create_names, values, context=FakeCompletionContext())
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ImageCache(os.path.join(directory, "images.sqlite"))
+        things = {value.thing for value in values}
+        timed(times, "images", cached_image_search_all, things, cache, FakeSearcher())
+        timed(times, "images_cached", cached_image_search_all, things, cache)
+
+    random.seed(seed)
+    new_questions = timed(
+        times, "random_questions", generate.random_questions, values, set(), questions
+    )
+    if rows <= exhaustive_rows:
+        timed(
+            times,
+            "exhaustive_questions",
+            generate.exhaustive_questions,
+            values,
+            set(),
+            questions,
+            seed=seed,
+        )
+
+    text = timed(
+        times, "serialize_values", lambda: json.dumps([v.serialize() for v in values])
+    )
+    timed(
+        times,
+        "deserialize_values",
+        lambda: [Value.deserialize(data) for data in json.loads(text)],
+    )
+    # memory held by the loaded values, with the JSON they came from freed
+    memory = {}
+    _, size = allocated(lambda: [Value.deserialize(data) for data in json.loads(text)])
+    memory["value"] = size / len(values)
+    text = timed(
+        times,
+        "serialize_questions",
+        lambda: json.dumps([question.serialize() for question in new_questions]),
+    )
+    timed(
+        times,
+        "deserialize_questions",
+        lambda: [Question.deserialize(data) for data in json.loads(text)],
+    )
+    _, size = allocated(
+        lambda: [Question.deserialize(data) for data in json.loads(text)]
+    )
+    memory["question"] = size / max(len(new_questions), 1)
+    return {
+        "rows": rows,
+        "values": len(values),
+        "seconds": times,
+        "bytes_per": memory,
+    }
+
+
+@click.command()
+@click.option("--rows", "-r", multiple=True, type=int, default=[1000, 10000, 100000])
+@click.option("--seed", "-s", default=0)
+@click.option("--questions", default=1000, help="Questions to generate each time")
+@click.option("--exhaustive-rows", default=10000, help="Most rows to time -e on")
+@click.option("--output", "-o", type=click.Path(), default="bench.json")
+@click.option(
+    "--compare",
+    type=click.File("r"),
+    help="An earlier output to print how long each stage takes relative to",
+)
+def main(rows, seed, questions, exhaustive_rows, output, compare):
+    previous = {}
+    if compare:
+        runs = json.load(compare)["runs"]
+        previous = {entry["rows"]: entry["seconds"] for entry in runs}
+    runs = []
+    for count in rows:
+        result = run(count, seed, questions, exhaustive_rows)
+        runs.append(result)
+        print(f"{count} rows, {result['values']} values")
+        for stage, seconds in result["seconds"].items():
+            line = f"  {stage:<24}{seconds:10.4f}s"
+            before = previous.get(count, {}).get(stage)
+            if before:
+                line += f"  x{seconds / before:.2f}"
+            print(line)
+        for record, size in result["bytes_per"].items():
+            print(f"  bytes per {record:<14}{size:10.0f}")
+    with open(output, "w") as file:
+        json.dump(
+            {
+                "created": now(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "seed": seed,
+                "runs": runs,
+            },
+            file,
+            indent=2,
+        )
+
+
+if __name__ == "__main__":
+    main()
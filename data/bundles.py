@@ -0,0 +1,159 @@
+from __future__ import annotations
+from collections import defaultdict
+from datetime import date, timedelta
+import hashlib
+import json
+import math
+import os
+from typing import Dict, List
+
+from question import Question
+
+MANIFEST = "manifest.json"
+
+
+def client_value(value) -> Dict:
+    """Only what the app shows of a value"""
+    data = {"value": value.value.serialize(), "name": value.name}
+    if value.image:
+        data["image"] = value.image
+    return data
+
+
+def client_question(question: Question) -> Dict:
+    return {
+        "question": question.question,
+        "answer": question.answer,
+        "log_answer": round(math.log10(question.answer), 6),
+        "difficulty": round(question.difficulty(), 6),
+        "values": [client_value(value) for value in question.values],
+    }
+
+
+def minified(data) -> str:
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+
+def content_name(prefix: str, text: str) -> str:
+    """A filename that changes whenever the text does, so it can be cached forever"""
+    digest = hashlib.sha256(text.encode()).hexdigest()[:12]
+    return f"{prefix}-{digest}.json"
+
+
+def hint_index(questions: List[Question], size: int, width=0.5) -> Dict:
+    """
+    Where to find every question, as the questions of shards of size: their
+    log10(answer), difficulty, shard and position in it, sorted by
+    log10(answer) so the ones near a magnitude can be found with a binary
+    search. Buckets of width orders of magnitude list the positions of their
+    questions in those lists from easiest to hardest. Only the shards of the
+    hints shown need to be fetched.
+    """
+    entries = sorted(
+        (
+            round(math.log10(question.answer), 6),
+            round(question.difficulty(), 6),
+            i // size,
+            i % size,
+        )
+        for i, question in enumerate(questions)
+    )
+    buckets: Dict[int, List[int]] = defaultdict(list)
+    for i, (log_answer, *_) in enumerate(entries):
+        buckets[math.floor(log_answer / width)].append(i)
+    log_answers, difficulties, shards, positions = (
+        [entry[n] for entry in entries] for n in range(4)
+    )
+    return {
+        "width": width,
+        "log_answers": log_answers,
+        "difficulties": difficulties,
+        "shards": shards,
+        "positions": positions,
+        "buckets": [
+            {
+                "from": bucket * width,
+                "questions": sorted(found, key=lambda i: difficulties[i]),
+            }
+            for bucket, found in sorted(buckets.items())
+        ],
+    }
+
+
+def write_file(directory: str, prefix: str, data) -> str:
+    """Write data under its content name, unless it's already there"""
+    text = minified(data)
+    name = content_name(prefix, text)
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        with open(path, "w") as file:
+            file.write(text)
+    return name
+
+
+def read_manifest(directory: str) -> Dict:
+    try:
+        with open(os.path.join(directory, MANIFEST), "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def write_bundles(
+    questions: List[Question],
+    directory: str,
+    days=7,
+    per_day=1,
+    start: date | None = None,
+    hint_width=0.5,
+) -> Dict:
+    """
+    Split the questions into shards of days days each, with per_day questions
+    for each day, and write them to directory along with a manifest of which
+    shard covers which days. Questions keep their order, so adding questions
+    only changes the last shard and adds new ones. The start date is kept
+    from an existing manifest unless one is given, so days don't move between
+    exports. A hint index pointing into the shards (see hint_index) is
+    written too. Files the manifest no longer lists are removed.
+    """
+    questions = [question for question in questions if question.answer > 0]
+    previous = read_manifest(directory)
+    if start is None:
+        start = date.fromisoformat(previous.get("start", date.today().isoformat()))
+    os.makedirs(directory, exist_ok=True)
+    size = days * per_day
+    shards = []
+    for i in range(0, len(questions), size):
+        shard = [client_question(question) for question in questions[i : i + size]]
+        name = write_file(directory, "questions", shard)
+        first = start + timedelta(days=i // per_day)
+        shards.append(
+            {
+                "file": name,
+                "from": first.isoformat(),
+                "count": len(questions[i : i + size]),
+            }
+        )
+    manifest = {
+        "start": start.isoformat(),
+        "days": days,
+        "per_day": per_day,
+        "questions": len(questions),
+        "shards": shards,
+        "hints": write_file(
+            directory, "hints", hint_index(questions, size, hint_width)
+        ),
+    }
+    with open(os.path.join(directory, MANIFEST), "w") as file:
+        file.write(minified(manifest))
+    kept = {shard["file"] for shard in shards} | {manifest["hints"]}
+    stale = [shard["file"] for shard in previous.get("shards", [])]
+    if "hints" in previous:
+        stale.append(previous["hints"])
+    for name in stale:
+        if name not in kept:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+    return manifest
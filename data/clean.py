@@ -5,15 +5,21 @@ import re
 from pandas import DataFrame, isna
 from dataclasses import dataclass, field, asdict
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from pprint import pprint
 import numpy as np
-from typing import Dict, List, Callable
+from typing import Dict, List, Callable, Tuple
+import inspect
 import json
+import sys
 import click
+from data import default
 from value import Value, Thing
 
-import units
 import alter
+import profiling
+import store
+import units
 
 number_regex = r"-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?"
 range_regex = f"{number_regex}(?:-{number_regex})*"
@@ -48,7 +54,13 @@ def colon_separated_values(value: str):
         pairs[p1] = p2
     return pairs
 
-def get_things(df: DataFrame) -> List[Thing]:
+def parse_tags(tags) -> List[str]:
+    tags = "" if isna(tags) else tags
+    return [tag.lower().strip() for tag in tags.split(", ") if tag]
+
+
+def get_things_by_row(df: DataFrame) -> List[Thing]:
+    """Parse the frame one row and one cell at a time"""
     things = []
     for thing_name in df.index:
         row = df.loc[thing_name].dropna()
@@ -87,7 +99,8 @@ def get_things(df: DataFrame) -> List[Thing]:
                         measurement=measurement,
                         thing=thing_name,
                         original=val,
-                        image=image
+                        image=image,
+                        tags=thing.tags,
                     )
                 )
         thing.values = dict(values)
@@ -96,49 +109,272 @@ def get_things(df: DataFrame) -> List[Thing]:
     return things
 
 
-def clean(file):
-    df = pandas.read_csv(file, sep="\t")
-    df = df.rename(columns=lambda x: x.strip().lower())
-    df = df[
-        [
-            "thing",
-            "volume",
-            "surface area",
-            "length",
-            "mass",
-            "time/age",
-            "count",
-            "speed",
-            "temperature",
-            "density",
-            "frequency",
-            "energy",
-            "power",
-            "loudness",
-            "charge",
-            "other",
-            "tags",
-            "sources"
-        ]
-    ].copy()
-    df = drop_empty(df)
+def get_things(df: DataFrame) -> List[Thing]:
+    """
+    Parse every cell of the frame at once, giving the same things as
+    get_things_by_row
+    """
+    measurements = [
+        col for col in df.columns if col not in ("tags", "sources", "thing")
+    ]
+    # (row position, measurement, fragment), in row then column order
+    cells = df[measurements].set_axis(range(len(df))).stack()
+    if cells.empty:
+        cells = cells.astype(object)
+    fragments = cells.str.split(",").explode().str.strip()
+    parts = fragments.str.extract(f"^{value_regex.pattern}")
+    # ranges are broken, like parse_number. The strings are cast by numpy
+    # rather than pandas.to_numeric, which does not always round like float()
+    magnitudes = np.full(len(parts), np.nan)
+    is_number = parts[1].str.fullmatch(number_regex, na=False).to_numpy()
+    magnitudes[is_number] = parts[1].to_numpy()[is_number].astype(np.float64)
+    ok = ~np.isnan(magnitudes) & (magnitudes != 0)
 
-    df = df.set_index("thing", drop=True)
-    things = get_things(df)
+    # standardize all the values with the same unit string together
+    unit_strings = parts[2].fillna("").to_numpy()
+    valid = np.flatnonzero(ok)
+    groups = pandas.Series(valid).groupby(unit_strings[valid]).indices
+    table = units.conversion_table(units.preferred)
+    standard_units = {}
+    for unit, indices in groups.items():
+        indices = valid[indices]
+        magnitudes[indices], standard_units[unit] = table.convert(
+            magnitudes[indices], units.parse_units(unit)
+        )
+
+    things = []
+    images = []
+    for thing_name, tags, sources in zip(
+        df.index,
+        df["tags"] if "tags" in df else [""] * len(df),
+        df["sources"] if "sources" in df else [""] * len(df),
+    ):
+        sources = colon_separated_values("" if isna(sources) else sources)
+        images.append(sources.get("image", ""))
+        things.append(
+            Thing(
+                thing_name,
+                tags=parse_tags(tags),
+                values=defaultdict(list),
+                broken=defaultdict(list),
+            )
+        )
+
+    specifiers = parts[0].fillna("").str.lower().to_numpy()
+    rows = zip(
+        fragments.index.get_level_values(0),
+        fragments.index.get_level_values(1),
+        fragments.to_numpy(),
+        ok,
+        specifiers,
+        magnitudes.tolist(),
+        unit_strings,
+    )
+    for position, measurement, val, val_ok, specifier, magnitude, unit in rows:
+        thing = things[position]
+        if not val_ok:
+            thing.broken[measurement].append(val)
+            continue
+        if np.isfinite(magnitude):
+            quantity = units.Quantity(magnitude, standard_units[unit])
+        else:
+            # overflowing numbers don't survive a round trip through a string
+            quantity = units.Quantity.from_str(f"{magnitude} {unit}")
+            quantity = quantity.standardized(units.preferred)
+        thing.values[measurement].append(
+            Value(
+                quantity,
+                specifier=specifier,
+                measurement=measurement,
+                thing=thing.name,
+                original=val,
+                image=images[position],
+                tags=thing.tags,
+            )
+        )
+    for thing in things:
+        thing.values = dict(thing.values)
+        thing.broken = dict(thing.broken)
+    return things
+
+
+COLUMNS = [
+    "thing",
+    "volume",
+    "surface area",
+    "length",
+    "mass",
+    "time/age",
+    "count",
+    "speed",
+    "temperature",
+    "density",
+    "frequency",
+    "energy",
+    "power",
+    "loudness",
+    "charge",
+    "other",
+    "tags",
+    "sources",
+]
+
+
+def read_frame(file) -> DataFrame:
+    with profiling.stage("read"):
+        df = pandas.read_csv(file, sep="\t")
+        df = df.rename(columns=lambda x: x.strip().lower())
+        df = df[COLUMNS].copy()
+        df = drop_empty(df)
+        profiling.count("rows", len(df))
+        return df.set_index("thing", drop=True)
+
+
+def alter_things(things: List[Thing]):
     for thing in things:
         thing.alter(alter.alter_map.get("", []))
         for tag in thing.tags:
             thing.alter(alter.alter_map.get(tag, []))
+    return things
 
-    values: List[Value] = [
-        value
-        for thing in things
-        for values in thing.values.values()
-        for value in values
-    ]
+
+def thing_values(thing: Thing) -> List[Value]:
+    return [value for values in thing.values.values() for value in values]
+
+
+def process_rows(df: DataFrame) -> List[List[Value]]:
+    """The values of each row, parsed, standardized and altered"""
+    with profiling.stage("clean"):
+        things = get_things(df)
+    with profiling.stage("alter"):
+        return [thing_values(thing) for thing in alter_things(things)]
+
+
+def process_frame(df: DataFrame, jobs=1) -> List[List[Value]]:
+    """
+    process_rows, with chunks of rows spread over jobs processes and put
+    back in order
+    """
+    if jobs <= 1 or len(df) < 2 * jobs:
+        return process_rows(df)
+    bounds = np.linspace(0, len(df), 4 * jobs + 1).astype(int)
+    chunks = [df.iloc[start:end] for start, end in zip(bounds, bounds[1:])]
+    # the workers' stages aren't seen here, so their alter time counts as clean
+    with profiling.stage("clean"), ProcessPoolExecutor(jobs) as executor:
+        chunks = executor.map(process_rows, chunks)
+        return [rows for chunk in chunks for rows in chunk]
+
+
+def clean(file, jobs=1):
+    rows = process_frame(read_frame(file), jobs)
+    values: List[Value] = [value for values in rows for value in values]
     return values
 
 
+def pipeline_version():
+    """Changes whenever the code turning rows into values might have"""
+    modules = (sys.modules[__name__], units, alter, inspect.getmodule(Value))
+    sources = [inspect.getsource(module) for module in modules]
+    code = [pandas.__version__, *sources]
+    return store.digest(json.dumps(code))
+
+
+def row_digests(df: DataFrame) -> List[str]:
+    """A digest of each row's thing and cells"""
+    # every column, so dropping an empty one elsewhere doesn't change them
+    df = df.reindex(columns=COLUMNS[1:])
+    return [f"{h:016x}" for h in pandas.util.hash_pandas_object(df, index=True)]
+
+
+@dataclass
+class Rows:
+    """
+    The digest and thing of each row of a sheet, with how many values it
+    gave, in the order the values were written
+    """
+
+    version: str = ""
+    rows: List[Tuple[str, str, int]] = default(list)
+
+    @staticmethod
+    def load(path: str):
+        try:
+            with open(path, "r") as file:
+                data = json.load(file)
+            rows = [(digest, thing, count) for digest, thing, count in data["rows"]]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError, ValueError):
+            return Rows()
+        return Rows(data["version"], rows)
+
+    def save(self, path: str):
+        with open(path, "w") as file:
+            file.write(json.dumps({"version": self.version, "rows": self.rows}))
+
+    def offsets(self) -> List[int]:
+        """Where the values of each row start"""
+        return np.cumsum([0] + [count for _, _, count in self.rows]).tolist()[:-1]
+
+
+@dataclass
+class Cleaned:
+    """
+    The rows of a sheet, each reusing the values of the previous row at
+    sources[position], or with fresh values if that is None
+    """
+
+    rows: Rows
+    sources: List[int | None]
+    fresh: Dict[int, List[Value]]
+
+    def fresh_values(self) -> List[Value]:
+        return [
+            value for position in sorted(self.fresh) for value in self.fresh[position]
+        ]
+
+    def reused_things(self):
+        return {
+            thing
+            for (_, thing, _), source in zip(self.rows.rows, self.sources)
+            if source is not None
+        }
+
+
+def clean_incremental(file, previous: Rows, jobs=1) -> Cleaned:
+    """
+    Like clean, but rows with the same digest as a row of previous reuse its
+    values rather than being parsed again. A thing's values can share keys
+    across its rows, so all the rows of a thing with a new, changed or
+    removed row are parsed again.
+    """
+    df = read_frame(file)
+    digests = row_digests(df)
+    things = df.index.tolist()
+    version = pipeline_version()
+    known = previous.rows if previous.version == version else []
+    unclaimed = defaultdict(list)
+    for position, (row_digest, _, _) in reversed(list(enumerate(known))):
+        unclaimed[row_digest].append(position)
+    sources = [
+        unclaimed[row_digest].pop() if unclaimed.get(row_digest) else None
+        for row_digest in digests
+    ]
+    changed_things = {thing for thing, source in zip(things, sources) if source is None}
+    for positions in unclaimed.values():
+        changed_things.update(known[position][1] for position in positions)
+    sources = [
+        None if thing in changed_things else source
+        for thing, source in zip(things, sources)
+    ]
+    changed = [position for position, source in enumerate(sources) if source is None]
+    fresh = dict(zip(changed, process_frame(df.iloc[changed], jobs)))
+    counts = [
+        len(fresh[position]) if source is None else known[source][2]
+        for position, source in enumerate(sources)
+    ]
+    print(f"Rows reused: {len(digests) - len(changed)}, parsed: {len(changed)}")
+    return Cleaned(Rows(version, list(zip(digests, things, counts))), sources, fresh)
+
+
 @click.command()
 @click.argument("input", type=click.File("r"), default="Fermidle - Values.tsv")
 @click.argument("output", type=click.File("w"), default="values.json")
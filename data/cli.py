@@ -1,21 +1,80 @@
 import json
 import math
 import random
+from collections import Counter
 from typing import List
 import click
-import clean
-from images import image_search
-from question import Question
+import profiling
+import store
+from question import Question, deserialize_normalized, serialize_normalized
 from value import Value
-from natural_language import create_names
 
+# clean, columnar, generate, images and natural_language bring in pandas,
+# pyarrow, numpy, requests and openai, so each command imports only the ones
+# it uses
 
-def generate_names(values: List[Value], manual=False):
-    values = create_names(values, manual=manual)
+
+def generate_names(
+    values: List[Value],
+    manual=False,
+    workers=1,
+    completion_cache="",
+    batch_size=1,
+    example_tokens=0,
+    rules=False,
+    replay=False,
+):
+    from natural_language import (
+        CachedCompletionContext,
+        OpenAICompletionContext,
+        create_names,
+    )
+
+    context = None
+    if replay:
+        # no live context, so prompts missing from the cache leave values unnamed
+        context = CachedCompletionContext(
+            None, completion_cache, model=OpenAICompletionContext.model
+        )
+    elif completion_cache and not manual:
+        context = CachedCompletionContext(OpenAICompletionContext(), completion_cache)
+    values = create_names(
+        values,
+        manual=manual,
+        workers=workers,
+        context=context,
+        batch_size=batch_size,
+        example_tokens=example_tokens,
+        rules=rules,
+    )
     return values
 
 
+def is_jsonl(filename: str):
+    return str(filename).endswith(".jsonl")
+
+
+def is_parquet(filename: str):
+    return str(filename).endswith(".parquet")
+
+
+def values_store(filename: str):
+    return store.JsonlStore(filename, Value.key, Value.serialize, Value.deserialize)
+
+
+def questions_store(filename: str):
+    return store.JsonlStore(
+        filename, Question.key, Question.serialize, Question.deserialize
+    )
+
+
 def load_values(filename: str):
+    if is_jsonl(filename):
+        return values_store(filename).load()
+    if is_parquet(filename):
+        import columnar
+
+        return columnar.read_values(filename)
     try:
         with open(filename, "r") as file:
             return [Value.deserialize(value) for value in json.load(file)]
@@ -27,108 +86,644 @@ def save_values(values, file):
     json.dump([value.serialize() for value in values], file, indent=2)
 
 
-def create_values(input_file, values_filename, manual=False):
-    values = clean.clean(input_file)
-    existing_values = load_values(values_filename)
-    existing_values = {value.key(): value for value in existing_values}
-    for value in values:
+def load_records(filename: str):
+    """
+    The values already written, as they are quickest to reuse: the store of
+    a .jsonl file, the values of a .parquet file, or the text of each value
+    in a JSON file (see store.array_items)
+    """
+    if is_jsonl(filename):
+        return values_store(filename)
+    if is_parquet(filename):
+        return load_values(filename)
+    try:
+        with open(filename, "r") as file:
+            return store.array_items(file.read())
+    except FileNotFoundError:
+        return []
+
+
+def record_value(record) -> Value:
+    if isinstance(record, str):
+        return Value.deserialize(json.loads(record))
+    return record
+
+
+def thing_of(key) -> str:
+    # store keys are a value's key (see Value.key) and a number
+    return key[0][0]
+
+
+def matching_rows(rows, records):
+    """
+    The rows whose values are all still in records, since other commands
+    write the values without them
+    """
+    if isinstance(records, store.JsonlStore):
+        counts = Counter(thing_of(key) for key in records.keys())
+        expected = Counter()
+        for _, thing, count in rows.rows:
+            expected[thing] += count
+        rows.rows = [row for row in rows.rows if counts[row[1]] == expected[row[1]]]
+    elif sum(count for _, _, count in rows.rows) != len(records):
+        rows.rows = []
+    return rows
+
+
+def reused_slices(previous, cleaned):
+    """Where the values of each reused row are in the previous records"""
+    offsets = previous.offsets()
+    return {
+        position: slice(offsets[source], offsets[source] + previous.rows[source][2])
+        for position, source in enumerate(cleaned.sources)
+        if source is not None
+    }
+
+
+def replaced_values(records, previous, cleaned) -> List[Value]:
+    """The values already written that the cleaned rows don't reuse"""
+    if isinstance(records, store.JsonlStore):
+        reused = cleaned.reused_things()
+        keys = [key for key in records.keys() if thing_of(key) not in reused]
+        return [Value.deserialize(record) for record in records.raw(keys)]
+    kept = [False] * len(records)
+    for span in reused_slices(previous, cleaned).values():
+        kept[span] = [True] * (span.stop - span.start)
+    return [record_value(r) for r, keep in zip(records, kept) if not keep]
+
+
+def clean_values(input_file, values_filename, incremental=False, jobs=1):
+    """
+    Parse the sheet into the values file, keeping the names and images the
+    values had. With incremental, rows that didn't change since the last run
+    keep their values as they were written, without being parsed or written
+    again. Returns the values of the rows that were parsed.
+    """
+    import clean
+
+    with profiling.stage("load"):
+        records = load_records(values_filename)
+        previous = clean.Rows()
+        if incremental:
+            previous = clean.Rows.load(rows_filename(values_filename))
+            previous = matching_rows(previous, records)
+    cleaned = clean.clean_incremental(input_file, previous, jobs=jobs)
+    fresh = cleaned.fresh_values()
+    with profiling.stage("load"):
+        replaced = replaced_values(records, previous, cleaned)
+    existing_values = {value.key(): value for value in replaced}
+    for value in fresh:
         existing = existing_values.get(value.key())
         if existing:
             value.name = existing.name
             value.quality = existing.quality
             value.generated = existing.generated
             value.image = existing.image or value.image
+    with profiling.stage("save"):
+        write_cleaned(records, previous, cleaned, values_filename)
+    return fresh
+
+
+def write_cleaned(records, previous, cleaned, values_filename):
+    """Write the values of cleaned, only changing the ones that were parsed"""
+    if isinstance(records, store.JsonlStore):
+        fresh = cleaned.fresh_values()
+        fresh_keys = set(store.numbered(value.key() for value in fresh))
+        reused = cleaned.reused_things()
+        stale = [
+            key
+            for key in records.keys()
+            if thing_of(key) not in reused and key not in fresh_keys
+        ]
+        print("Values written:", records.write(fresh, delete=stale))
+    else:
+        slices = reused_slices(previous, cleaned)
+        values = []
+        for position in range(len(cleaned.sources)):
+            if position in slices:
+                values.extend(records[slices[position]])
+            elif is_parquet(values_filename):
+                values.extend(cleaned.fresh[position])
+            else:
+                values.extend(
+                    store.item_text(value.serialize())
+                    for value in cleaned.fresh[position]
+                )
+        if is_parquet(values_filename):
+            import columnar
+
+            columnar.write_values(values, values_filename)
+        else:
+            with open(values_filename, "w") as values_file:
+                values_file.write(store.join_items(values))
+    cleaned.rows.save(rows_filename(values_filename))
+
+
+def rows_filename(values_filename: str):
+    return f"{values_filename}.rows"
+
+
+def write_values(values: List[Value], values_filename):
+    with profiling.stage("save"):
+        if is_jsonl(values_filename):
+            print("Values written:", values_store(values_filename).replace(values))
+        elif is_parquet(values_filename):
+            import columnar
+
+            columnar.write_values(values, values_filename)
+        else:
+            with open(values_filename, "w") as values_file:
+                save_values(values, values_file)
+
+
+def create_values(
+    input_file,
+    values_filename,
+    manual=False,
+    image_cache="images.sqlite",
+    refresh_images=False,
+    image_workers=4,
+    name_workers=1,
+    completion_cache="",
+    name_batch=1,
+    example_tokens=0,
+    rules=False,
+    replay=False,
+    incremental=False,
+    jobs=1,
+):
+    fresh = clean_values(input_file, values_filename, incremental, jobs)
+    with profiling.stage("load"):
+        values = load_values(values_filename)
+    with profiling.stage("naming"):
+        values = generate_names(
+            values,
+            manual=manual,
+            workers=name_workers,
+            completion_cache=completion_cache,
+            batch_size=name_batch,
+            example_tokens=example_tokens,
+            rules=rules,
+            replay=replay,
+        )
+    with profiling.stage("images"):
+        add_images(values, fresh, image_cache, refresh_images, image_workers)
+    write_values(values, values_filename)
+    return [value for value in values if value.name]
+
+
+def add_images(
+    values: List[Value],
+    fresh: List[Value],
+    image_cache="images.sqlite",
+    refresh_images=False,
+    image_workers=4,
+):
+    """Find images for the things of the fresh values that don't have one"""
+    from images import ImageCache, ImageSearcher, cached_image_search_all
 
-    values = generate_names(values, manual=manual)
     images = {}
     for value in values:
         images[value.thing] = value.image or images.get(value.thing, "")
-    try:
-        for thing in images.keys():
-            image = images[thing]
-            if not image.startswith("http"):
-                image_url = image_search(image or thing) or ""
-                images[thing] = image_url
-                print(image, thing, image_url)
-    except KeyboardInterrupt:
-        pass
+    fresh_things = {value.thing for value in fresh}
+    queries = {
+        thing: image or thing
+        for thing, image in images.items()
+        if thing in fresh_things and not image.startswith("http")
+    }
+    found = cached_image_search_all(
+        queries.values(),
+        ImageCache(image_cache),
+        ImageSearcher(workers=image_workers),
+        refresh=refresh_images,
+    )
+    for thing, query in queries.items():
+        # searches cut short by KeyboardInterrupt are left as they were
+        if query in found:
+            image_url = found[query] or ""
+            print(images[thing], thing, image_url)
+            images[thing] = image_url
     for value in values:
         value.image = images[value.thing]
-    with open(values_filename, "w") as values_file:
-        save_values(values, values_file)
-    return [value for value in values if value.name]
 
 
-def load_questions(filename: str = "./questions.json"):
+def load_questions(filename: str = "./questions.json", values: List[Value] = ()):
+    """
+    The questions in a file. Parquet files only refer to their values, so
+    they are looked up in values.
+    """
+    if is_jsonl(filename):
+        return questions_store(filename).load()
+    if is_parquet(filename):
+        import columnar
+
+        return columnar.read_questions(filename, values)
     try:
         with open(filename, "r") as f:
-            return [Question.deserialize(data) for data in json.load(f)]
+            data = json.load(f)
     except FileNotFoundError:
         return []
+    if isinstance(data, dict):
+        return deserialize_normalized(data)
+    return [Question.deserialize(question) for question in data]
+
+
+def is_normalized(filename: str):
+    """Whether a JSON questions file keeps its values in a table of their own"""
+    if is_jsonl(filename) or is_parquet(filename):
+        return False
+    try:
+        with open(filename, "r") as file:
+            return file.read(64).lstrip().startswith("{")
+    except FileNotFoundError:
+        return False
 
 
-def save_questions(questions: List[Question], file):
-    json.dump([question.serialize() for question in questions], file, indent=2)
+def save_questions(questions: List[Question], file, normalized=False):
+    if normalized:
+        json.dump(serialize_normalized(questions), file, indent=2)
+    else:
+        json.dump([question.serialize() for question in questions], file, indent=2)
 
 
-def create_questions(values: List[Value], questions_filename, count=20):
-    questions = load_questions(questions_filename)
+def create_questions(
+    values: List[Value],
+    questions_filename,
+    count=20,
+    exhaustive=False,
+    min_magnitude=-math.inf,
+    max_magnitude=math.inf,
+    normalize=False,
+):
+    import generate
+
+    with profiling.stage("load"):
+        normalize = normalize or is_normalized(questions_filename)
+        questions = load_questions(questions_filename, values)
     keys = {question.key() for question in questions}
-    generated = 0
-    tries = 0
-    while generated < count and tries < 1e6:
-        tries += 1
-        matches = []
-        while not matches:
-            value1 = random.choice(values)
-            matches = [
-                value
-                for value in values
-                if value.measurement == value1.measurement
-                and value.thing != value1.thing
-                and str(value.value.units) == str(value1.value.units)
-            ]
-        value2 = random.choice(matches)
-        answer = value1.value / value2.value
-        answer_magnitude = math.log10(answer.value)
-        if answer_magnitude < -3 and random.random() > 2 ** (answer_magnitude / 4):
-            value1, value2 = value2, value1
-        answer = value1.value / value2.value
-        answer_magnitude = math.log10(answer.value)
-        question = Question(
-            [value1, value2],
-            f"What is the ratio of the *{value1.name}* to the *{value2.name}*",
-            answer=answer.value,
-            quality=1.0,
-            measurement=value1.measurement,
-            style="ratio",
-        )
-        key = question.key()
-        if key not in keys:
-            questions.append(question)
-            keys.add(key)
-            generated += 1
-            tries = 0
-    with open(questions_filename, "w") as questions_file:
-        save_questions(questions, questions_file)
+    with profiling.stage("questions"):
+        if exhaustive:
+            seed = random.getrandbits(32)
+            new_questions = generate.exhaustive_questions(
+                values, keys, count, min_magnitude, max_magnitude, seed=seed
+            )
+        else:
+            new_questions = generate.random_questions(values, keys, count)
+        profiling.count("questions", len(new_questions))
+    questions.extend(new_questions)
+    with profiling.stage("save"):
+        if is_jsonl(questions_filename):
+            questions_store(questions_filename).write(new_questions)
+        elif is_parquet(questions_filename):
+            import columnar
+
+            columnar.append_questions(new_questions, questions_filename)
+        else:
+            with open(questions_filename, "w") as questions_file:
+                save_questions(questions, questions_file, normalize)
     return questions
 
 
-@click.command()
-@click.argument("input", type=click.File("r"), default="Fermidle - Values.tsv")
-@click.argument("output", type=click.Path(), default="questions.json")
+def options(*decorators):
+    """Apply click decorators in the order they are listed, like stacking them"""
+
+    def apply(fn):
+        for decorator in reversed(decorators):
+            fn = decorator(fn)
+        return fn
+
+    return apply
+
+
+clean_options = options(
+    click.argument("input", type=click.File("r"), default="Fermidle - Values.tsv"),
+    click.option(
+        "--incremental",
+        "-i",
+        is_flag=True,
+        help="Only process rows that changed since the values were last written",
+    ),
+    click.option("--jobs", default=1, help="Processes to clean the sheet with"),
+)
+naming_options = options(
+    click.option("--manual", "-m", is_flag=True),
+    click.option("--name-workers", default=1, help="Names to request at once"),
+    click.option("--name-batch", default=1, help="Values to name in each request"),
+    click.option(
+        "--example-tokens",
+        default=0,
+        help="Pick the most similar naming examples within this many tokens",
+    ),
+    click.option(
+        "--rules",
+        is_flag=True,
+        help="Name values that fit a known pattern without a completion",
+    ),
+    click.option(
+        "--completion-cache",
+        type=click.Path(),
+        default="completions.sqlite",
+        help="Where to keep generated names by prompt, or '' to not cache them",
+    ),
+    click.option(
+        "--replay",
+        is_flag=True,
+        help="Only use names from the completion cache, without requesting any",
+    ),
+)
+image_options = options(
+    click.option("--image-cache", type=click.Path(), default="images.sqlite"),
+    click.option(
+        "--refresh-images", is_flag=True, help="Ignore cached image search results"
+    ),
+    click.option("--image-workers", default=4, help="Image searches to run at once"),
+)
+question_options = options(
+    click.argument("output", type=click.Path(), default="questions.json"),
+    click.option("--count", "-c", default=20),
+    click.option(
+        "--exhaustive",
+        "-e",
+        is_flag=True,
+        help="Sample from every possible ratio question, or take all of them if count is 0",
+    ),
+    click.option("--min-magnitude", default=-math.inf),
+    click.option("--max-magnitude", default=math.inf),
+    click.option(
+        "--export-questions",
+        type=click.File("w"),
+        help="Write the .jsonl questions store out as a JSON array",
+    ),
+    click.option(
+        "--normalize",
+        is_flag=True,
+        help="Store each value once in the questions file, for the questions to refer to",
+    ),
+    click.option(
+        "--bundle",
+        type=click.Path(file_okay=False),
+        help="Also write the questions as daily bundles for the app to this directory",
+    ),
+)
+bundle_options = options(
+    click.option("--days", default=7, help="Days each bundle covers"),
+    click.option("--per-day", default=1, help="Questions for each day"),
+    click.option(
+        "--start",
+        type=click.DateTime(["%Y-%m-%d"]),
+        help="The first bundle's first day, instead of the one already bundled from",
+    ),
+)
+
+
+@click.group(invoke_without_command=True)
 @click.option("--values", type=click.Path(), default="values.json")
 @click.option("--seed", "-s", default="")
-@click.option("--manual", "-m", is_flag=True)
-@click.option("--judge", "-j", is_flag=True)
-@click.option("--count", "-c", default=20)
-def main(input, output, values, seed, manual, judge, count):
-    if seed:
-        random.seed(seed)
-    named_values = create_values(input, values, manual=manual)
+@click.option(
+    "--profile",
+    type=click.Path(),
+    help="Write the time, calls and max RSS of each stage here as JSON",
+)
+@click.option(
+    "--profile-memory",
+    is_flag=True,
+    help="Also trace the peak memory of each stage with --profile, which slows it",
+)
+@click.option(
+    "--profile-stage",
+    type=click.Choice(
+        ["read", "clean", "alter", "naming", "images", "questions", "load", "save"]
+    ),
+    help="Also write a cProfile of this stage next to the --profile trace",
+)
+@click.option(
+    "--export-values",
+    type=click.File("w"),
+    help="Write the .jsonl values store out as a JSON array",
+)
+@click.pass_context
+def main(ctx, values, seed, profile, profile_memory, profile_stage, export_values):
+    """Turn the sheet into values and questions, running everything by default"""
+    if export_values and not is_jsonl(values):
+        raise click.UsageError("Only .jsonl stores can be exported")
+    if profile_stage and not profile:
+        raise click.UsageError("--profile-stage needs --profile")
+    if profile_memory and not profile:
+        raise click.UsageError("--profile-memory needs --profile")
+    if profile:
+        profiling.profiler.enable(profile_stage, memory=profile_memory)
     if seed:
         random.seed(seed)
-    questions = create_questions(named_values, output, count=count)
+    ctx.obj = {"values": values, "seed": seed}
+    if ctx.invoked_subcommand is None:
+        ctx.invoke(all_command)
+
+
+@main.result_callback()
+@click.pass_context
+def finish(ctx, _result, values, profile, export_values, **_options):
+    if export_values:
+        values_store(values).export(export_values)
+    if profile:
+        profiling.profiler.save(profile)
+
+
+@main.command("clean")
+@clean_options
+@click.pass_obj
+def clean_command(obj, input, incremental, jobs):
+    """Parse the sheet into values, keeping the names and images they had"""
+    clean_values(input, obj["values"], incremental, jobs)
+
+
+def check_replay(replay, completion_cache, manual):
+    if replay and (manual or not completion_cache):
+        raise click.UsageError("--replay needs a --completion-cache and no --manual")
+
+
+@main.command("name")
+@naming_options
+@click.pass_obj
+def name_command(
+    obj,
+    manual,
+    name_workers,
+    name_batch,
+    example_tokens,
+    rules,
+    completion_cache,
+    replay,
+):
+    """Name the values that don't have a name yet"""
+    check_replay(replay, completion_cache, manual)
+    with profiling.stage("load"):
+        values = load_values(obj["values"])
+    with profiling.stage("naming"):
+        values = generate_names(
+            values,
+            manual=manual,
+            workers=name_workers,
+            completion_cache=completion_cache,
+            batch_size=name_batch,
+            example_tokens=example_tokens,
+            rules=rules,
+            replay=replay,
+        )
+    write_values(values, obj["values"])
+
+
+@main.command("images")
+@image_options
+@click.pass_obj
+def images_command(obj, image_cache, refresh_images, image_workers):
+    """Find images for the things that don't have one yet"""
+    with profiling.stage("load"):
+        values = load_values(obj["values"])
+    with profiling.stage("images"):
+        add_images(values, values, image_cache, refresh_images, image_workers)
+    write_values(values, obj["values"])
+
+
+def check_export(output, export_questions):
+    if export_questions and not is_jsonl(output):
+        raise click.UsageError("Only .jsonl stores can be exported")
+
+
+def make_questions(
+    obj,
+    values: List[Value],
+    output,
+    count,
+    exhaustive,
+    min_magnitude,
+    max_magnitude,
+    export_questions,
+    normalize,
+    bundle,
+    days,
+    per_day,
+    start,
+):
+    if obj["seed"]:
+        random.seed(obj["seed"])
+    questions = create_questions(
+        values,
+        output,
+        count=count,
+        exhaustive=exhaustive,
+        min_magnitude=min_magnitude,
+        max_magnitude=max_magnitude,
+        normalize=normalize,
+    )
+    if export_questions:
+        questions_store(output).export(export_questions)
+    if bundle:
+        write_bundles(questions, bundle, days, per_day, start)
+
+
+def write_bundles(questions: List[Question], directory, days, per_day, start):
+    import bundles
+
+    with profiling.stage("save"):
+        manifest = bundles.write_bundles(
+            questions, directory, days, per_day, start and start.date()
+        )
+    print(f"Bundled {manifest['questions']} questions", end=" ")
+    print(f"into {len(manifest['shards'])} files in {directory}")
+
+
+@main.command("questions")
+@question_options
+@bundle_options
+@click.pass_obj
+def questions_command(obj, **options):
+    """Make new questions from the named values"""
+    check_export(options["output"], options["export_questions"])
+    with profiling.stage("load"):
+        values = [value for value in load_values(obj["values"]) if value.name]
+    make_questions(obj, values, **options)
+
+
+@main.command("normalize")
+@click.argument("questions", type=click.Path(exists=True), default="questions.json")
+@click.argument("output", type=click.Path(), required=False)
+@click.option(
+    "--embedded",
+    is_flag=True,
+    help="Convert back, copying the values into each question that uses them",
+)
+def normalize_command(questions, output, embedded):
+    """Rewrite a JSON questions file to store each value once"""
+    for filename in (questions, output or questions):
+        if is_jsonl(filename) or is_parquet(filename):
+            raise click.UsageError("Only JSON questions files can be normalized")
+    loaded = load_questions(questions)
+    with open(output or questions, "w") as file:
+        save_questions(loaded, file, normalized=not embedded)
+    print(f"Wrote {len(loaded)} questions to {output or questions}")
+
+
+@main.command("bundle")
+@click.argument("questions", type=click.Path(), default="questions.json")
+@click.argument(
+    "output", type=click.Path(file_okay=False), default="../static/questions"
+)
+@bundle_options
+@click.pass_obj
+def bundle_command(obj, questions, output, days, per_day, start):
+    """Write the questions as minified daily bundles for the app"""
+    with profiling.stage("load"):
+        values = load_values(obj["values"]) if is_parquet(questions) else ()
+        questions = load_questions(questions, values)
+    write_bundles(questions, output, days, per_day, start)
+
+
+@main.command("all")
+@clean_options
+@naming_options
+@image_options
+@question_options
+@bundle_options
+@click.option("--judge", "-j", is_flag=True)
+@click.pass_obj
+def all_command(
+    obj,
+    input,
+    incremental,
+    jobs,
+    manual,
+    name_workers,
+    name_batch,
+    example_tokens,
+    rules,
+    completion_cache,
+    replay,
+    image_cache,
+    refresh_images,
+    image_workers,
+    judge,
+    **options,
+):
+    """Clean, name, find images and make questions"""
+    check_export(options["output"], options["export_questions"])
+    check_replay(replay, completion_cache, manual)
+    named_values = create_values(
+        input,
+        obj["values"],
+        manual=manual,
+        image_cache=image_cache,
+        refresh_images=refresh_images,
+        image_workers=image_workers,
+        name_workers=name_workers,
+        completion_cache=completion_cache,
+        name_batch=name_batch,
+        example_tokens=example_tokens,
+        rules=rules,
+        replay=replay,
+        incremental=incremental,
+        jobs=jobs,
+    )
+    make_questions(obj, named_values, **options)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,244 @@
+from __future__ import annotations
+import math
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from data import now
+from question import Question
+from units import Quantity, parse_units
+from value import Value
+
+# Strings that repeat across many rows are dictionary encoded
+category = pa.dictionary(pa.int32(), pa.string())
+
+VALUE_SCHEMA = pa.schema(
+    [
+        ("magnitude", pa.float64()),
+        ("units", category),
+        ("measurement", category),
+        ("thing", category),
+        ("specifier", category),
+        ("name", pa.string()),
+        ("note", category),
+        ("quality", pa.float64()),
+        ("generated", category),
+        ("image", category),
+        ("tags", pa.list_(pa.string())),
+    ]
+)
+
+# the columns besides the quantity, in the order read_values takes them
+VALUE_FIELDS = [
+    "name",
+    "measurement",
+    "thing",
+    "specifier",
+    "note",
+    "quality",
+    "generated",
+    "image",
+    "tags",
+]
+
+KEY_FIELDS = ["thing", "measurement", "specifier"]
+KEY_TYPE = pa.struct([(field, pa.string()) for field in KEY_FIELDS])
+
+QUESTION_SCHEMA = pa.schema(
+    [
+        ("id", pa.string()),
+        ("question", pa.string()),
+        ("answer", pa.float64()),
+        ("quality", pa.float64()),
+        ("measurement", category),
+        ("generated", category),
+        ("style", category),
+        # the keys of the values, which are kept in a values file
+        ("values", pa.list_(KEY_TYPE)),
+    ]
+)
+
+
+def read_table(path: str, columns: List[str] | None = None) -> pa.Table:
+    """Some or all of the columns of a file, memory mapped"""
+    return pq.read_table(path, columns=columns, memory_map=True)
+
+
+def values_table(values: Iterable[Value]) -> pa.Table:
+    values = list(values)
+    columns = {
+        "magnitude": [value.value.value for value in values],
+        "units": [str(value.value.units) for value in values],
+        "measurement": [value.measurement for value in values],
+        "thing": [value.thing for value in values],
+        "specifier": [value.specifier for value in values],
+        "name": [value.name for value in values],
+        "note": [value.note for value in values],
+        "quality": [value.quality for value in values],
+        "generated": [value.generated for value in values],
+        "image": [value.image for value in values],
+        "tags": [value.tags for value in values],
+    }
+    return pa.Table.from_pydict(columns, schema=VALUE_SCHEMA)
+
+
+def write_values(values: Iterable[Value], path: str):
+    pq.write_table(values_table(values), path)
+
+
+def column(table: pa.Table, name: str, convert: Callable = None) -> list:
+    """
+    A column as a list. Dictionary encoded strings are only decoded (and
+    converted) once each, so equal strings come out as the same object.
+    """
+    result = []
+    for chunk in table.column(name).chunks:
+        if pa.types.is_dictionary(chunk.type):
+            dictionary = chunk.dictionary.to_pylist()
+            if convert:
+                dictionary = [convert(item) for item in dictionary]
+            indices = chunk.indices.to_numpy(zero_copy_only=False).tolist()
+            result.extend(dictionary[i] for i in indices)
+        elif pa.types.is_list(chunk.type):
+            items = chunk.to_pylist()
+            result.extend(map(convert, items) if convert else items)
+        else:
+            items = chunk.to_numpy(zero_copy_only=False).tolist()
+            result.extend(map(convert, items) if convert else items)
+    return result
+
+
+def read_values(path: str, columns: List[str] | None = None) -> List[Value]:
+    """
+    The values in a file. With columns, only those are read, and the rest
+    of each value is left empty; the magnitude and units are always read.
+    """
+    if columns is not None:
+        columns = list(dict.fromkeys(["magnitude", "units", *columns]))
+    try:
+        table = read_table(path, columns)
+    except FileNotFoundError:
+        return []
+    # Value's defaults, shared by every row but the lists
+    empty = {"quality": 0.0, "generated": now()}
+    fields = []
+    for name in VALUE_FIELDS:
+        if name in table.column_names:
+            fields.append(column(table, name))
+        elif name == "tags":
+            fields.append([[] for _ in range(len(table))])
+        else:
+            fields.append([empty.get(name, "")] * len(table))
+    quantities = map(
+        Quantity, column(table, "magnitude"), column(table, "units", parse_units)
+    )
+    return [
+        Value(
+            quantity,
+            name=name,
+            measurement=measurement,
+            thing=thing,
+            specifier=specifier,
+            note=note,
+            quality=quality,
+            generated=generated,
+            image=image,
+            tags=tags,
+        )
+        for (
+            quantity,
+            name,
+            measurement,
+            thing,
+            specifier,
+            note,
+            quality,
+            generated,
+            image,
+            tags,
+        ) in zip(quantities, *fields)
+    ]
+
+
+def questions_table(questions: Iterable[Question]) -> pa.Table:
+    questions = list(questions)
+    columns = {
+        "id": [question.qid for question in questions],
+        "question": [question.question for question in questions],
+        "answer": [question.answer for question in questions],
+        "quality": [question.quality for question in questions],
+        "measurement": [question.measurement for question in questions],
+        "generated": [question.generated for question in questions],
+        "style": [question.style for question in questions],
+        "values": [
+            [dict(zip(KEY_FIELDS, value.key())) for value in question.values]
+            for question in questions
+        ],
+    }
+    return pa.Table.from_pydict(columns, schema=QUESTION_SCHEMA)
+
+
+def write_questions(questions: Iterable[Question], path: str):
+    pq.write_table(questions_table(questions), path)
+
+
+def append_questions(questions: Iterable[Question], path: str):
+    """
+    Add questions to a file, keeping the rows already there as they are, even
+    ones read_questions leaves out
+    """
+    table = questions_table(questions)
+    try:
+        table = pa.concat_tables([read_table(path).cast(QUESTION_SCHEMA), table])
+    except FileNotFoundError:
+        pass
+    pq.write_table(table, path)
+
+
+def answer_matches(question: Question) -> bool:
+    """Whether a ratio question's answer is still the ratio of its values"""
+    if question.style != "ratio" or len(question.values) != 2:
+        return True
+    first, second = (value.value.value for value in question.values)
+    return math.isclose(question.answer, first * second**-1, rel_tol=1e-9)
+
+
+def read_questions(path: str, values: Iterable[Value]) -> List[Question]:
+    """
+    The questions in a file, sharing the given values they refer to (the
+    first of any that share a key). Questions about values that aren't there,
+    or that have changed since the answer was worked out, are left out. They
+    stay in the file (see append_questions).
+    """
+    try:
+        table = read_table(path)
+    except FileNotFoundError:
+        return []
+    by_key: Dict[Tuple, Value] = {}
+    for value in values:
+        by_key.setdefault(value.key(), value)
+    questions = []
+    missing = 0
+    for row in table.to_pylist():
+        keys = [tuple(key.values()) for key in row["values"]]
+        if not all(key in by_key for key in keys):
+            missing += 1
+            continue
+        question = Question(
+            [by_key[key] for key in keys],
+            question=row["question"],
+            answer=row["answer"],
+            quality=row["quality"],
+            measurement=row["measurement"],
+            generated=row["generated"],
+            style=row["style"],
+            qid=row["id"],
+        )
+        if not answer_matches(question):
+            missing += 1
+            continue
+        questions.append(question)
+    if missing:
+        print(f"Left out {missing} questions about values that are missing or changed")
+    return questions
@@ -1,4 +1,5 @@
 from dataclasses import field
+import sys
 
 from datetime import datetime, timezone
 
@@ -8,4 +9,10 @@ def default(fn):
 
 
 def now():
-    return datetime.now(tz=timezone.utc).replace(microsecond=0).isoformat()
+    # records made in the same second share the string
+    return sys.intern(datetime.now(tz=timezone.utc).replace(microsecond=0).isoformat())
+
+
+def intern(string):
+    """The shared copy of a string that many records repeat"""
+    return sys.intern(string) if type(string) is str else string
@@ -0,0 +1,260 @@
+import math
+import random
+from collections import defaultdict
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from arrays import QuantityArray
+from question import Question
+from value import Value
+
+# Ratios smaller than this are usually flipped, since tiny answers are awkward
+SMALL_ANSWER_MAGNITUDE = -3
+
+
+def partner_key(value: Value):
+    return (value.measurement, value.value.units.dimension)
+
+
+class PartnerIndex:
+    """
+    Values bucketed by measurement and units, so that a value and a partner
+    from a different thing can be drawn without scanning every value
+    """
+
+    def __init__(self, values: List[Value]):
+        buckets: Dict[Tuple, Dict[str, List[Value]]] = defaultdict(dict)
+        for value in values:
+            buckets[partner_key(value)].setdefault(value.thing, []).append(value)
+        self.buckets: Dict[Tuple, List[Value]] = {}
+        # the slice of its bucket that each thing's values occupy
+        self.spans: Dict[Tuple, Dict[str, Tuple[int, int]]] = {}
+        for key, things in buckets.items():
+            # buckets of a single thing have no partners
+            if len(things) < 2:
+                continue
+            bucket = []
+            spans = {}
+            for thing, thing_values in things.items():
+                spans[thing] = (len(bucket), len(bucket) + len(thing_values))
+                bucket.extend(thing_values)
+            self.buckets[key] = bucket
+            self.spans[key] = spans
+        self.values = [value for value in values if partner_key(value) in self.buckets]
+
+    def partner(self, value: Value):
+        """A random value of the same bucket as value, but a different thing"""
+        key = partner_key(value)
+        bucket = self.buckets[key]
+        start, end = self.spans[key][value.thing]
+        i = random.randrange(len(bucket) - (end - start))
+        if i >= start:
+            i += end - start
+        return bucket[i]
+
+    def pair(self):
+        value1 = random.choice(self.values)
+        return value1, self.partner(value1)
+
+
+def ratio_question(value1: Value, value2: Value):
+    # partners share units, so the answer is just the ratio of the magnitudes
+    # (computed the same way as Quantity.__truediv__)
+    answer = value1.value.value * value2.value.value**-1
+    return Question(
+        [value1, value2],
+        f"What is the ratio of the *{value1.name}* to the *{value2.name}*",
+        answer=answer,
+        quality=1.0,
+        measurement=value1.measurement,
+        style="ratio",
+    )
+
+
+def random_questions(values: List[Value], keys: set, count=20):
+    """Draw random pairs of values until count new questions are found"""
+    questions = []
+    index = PartnerIndex(values)
+    if not index.values:
+        print("No values with a partner to compare to")
+    tries = 0
+    while len(questions) < count and tries < 1e6 and index.values:
+        tries += 1
+        value1, value2 = index.pair()
+        answer = value1.value / value2.value
+        answer_magnitude = math.log10(answer.value)
+        if answer_magnitude < SMALL_ANSWER_MAGNITUDE and random.random() > 2 ** (
+            answer_magnitude / 4
+        ):
+            value1, value2 = value2, value1
+        question = ratio_question(value1, value2)
+        key = question.key()
+        if key not in keys:
+            questions.append(question)
+            keys.add(key)
+            tries = 0
+    return questions
+
+
+def ratio_blocks(
+    bucket: List[Value],
+    spans: Dict[str, Tuple[int, int]],
+    excluded: Iterable[Tuple[int, int]] = (),
+    min_magnitude=-math.inf,
+    max_magnitude=math.inf,
+    block_size=1024,
+    key_ids: np.ndarray | None = None,
+):
+    """
+    Every (i, j) pair of a bucket of values making a valid ratio question,
+    as rows and columns of one block of the matrix of
+    log10(bucket[i] / bucket[j]) at a time. Small answers are always flipped,
+    so pairs below SMALL_ANSWER_MAGNITUDE are left to their reverse. With
+    key_ids, the ids of the values' keys, pairs with the same ids as an
+    earlier one make the same question, so are left out too.
+    """
+    size = len(bucket)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        magnitudes = np.log10(
+            QuantityArray.from_quantities(value.value for value in bucket).values
+        )
+    things = np.empty(size, dtype=np.int64)
+    for i, (start, end) in enumerate(spans.values()):
+        things[start:end] = i
+    excluded = np.array(sorted(i * size + j for i, j in excluded), dtype=np.int64)
+    low = max(min_magnitude, SMALL_ANSWER_MAGNITUDE)
+    shared = np.zeros(size, dtype=bool)
+    if key_ids is not None:
+        _, inverse, counts = np.unique(key_ids, return_inverse=True, return_counts=True)
+        shared = counts[inverse] > 1
+        key_count = key_ids.max() + 1
+    # values sharing a key are of the same thing, and blocks hold whole
+    # things, so the pairs they make are always in the same block
+    bounds = [0]
+    for start, end in spans.values():
+        if end - bounds[-1] > block_size and start > bounds[-1]:
+            bounds.append(start)
+    bounds.append(size)
+    for start, stop in zip(bounds, bounds[1:]):
+        ratios = magnitudes[start:stop, None] - magnitudes[None, :]
+        mask = things[start:stop, None] != things[None, :]
+        mask &= (ratios >= low) & (ratios <= max_magnitude)
+        if shared.any():
+            repeatable = mask & (shared[start:stop, None] | shared[None, :])
+            rows, cols = np.nonzero(repeatable)
+            pairs = key_ids[start + rows] * key_count + key_ids[cols]
+            _, first = np.unique(pairs, return_index=True)
+            mask[repeatable] = False
+            mask[rows[first], cols[first]] = True
+        block_rows, block_cols = np.nonzero(mask)
+        block_rows += start
+        if len(excluded):
+            keep = ~np.isin(block_rows * size + block_cols, excluded)
+            block_rows, block_cols = block_rows[keep], block_cols[keep]
+        yield block_rows, block_cols
+
+
+def exhaustive_questions(
+    values: List[Value],
+    keys: set,
+    count=0,
+    min_magnitude=-math.inf,
+    max_magnitude=math.inf,
+    seed=None,
+):
+    """
+    Every ratio question between the values that isn't in keys yet, with
+    an answer magnitude in the given window. If count is given, a seeded
+    sample of count of them instead, found by counting the candidates first
+    and then only keeping the chosen ones, so they never all are in memory.
+    """
+    index = PartnerIndex(values)
+    buckets = list(index.buckets.items())
+    positions = defaultdict(list)
+    for b, (_, bucket) in enumerate(buckets):
+        for i, value in enumerate(bucket):
+            positions[value.key()].append((b, i))
+    # values sharing a key make the same question, so each bucket position
+    # gets an id for its key, and whether positions of other buckets share it
+    key_ids = {key: n for n, key in enumerate(positions)}
+    ids, spread = [], []
+    for _, bucket in buckets:
+        bucket_keys = [value.key() for value in bucket]
+        ids.append(np.array([key_ids[key] for key in bucket_keys], dtype=np.int64))
+        spread.append(
+            np.array(
+                [len({other for other, _ in positions[key]}) > 1 for key in bucket_keys]
+            )
+        )
+    excluded = defaultdict(list)
+    for question_key in keys:
+        if len(question_key) != 3 or question_key[0] != "ratio":
+            continue
+        for b, i in positions.get(question_key[1], []):
+            for b2, j in positions.get(question_key[2], []):
+                if b == b2:
+                    excluded[b].append((i, j))
+
+    def blocks():
+        """
+        The candidates of every bucket, leaving out all but the first of the
+        ones making the same question, so they are only counted once
+        """
+        seen = set()
+        for b, (key, bucket) in enumerate(buckets):
+            bucket_blocks = ratio_blocks(
+                bucket,
+                index.spans[key],
+                excluded[b],
+                min_magnitude,
+                max_magnitude,
+                key_ids=ids[b],
+            )
+            for block_rows, block_cols in bucket_blocks:
+                # keys with values in several buckets can pair up in each
+                if spread[b].any():
+                    repeated = spread[b][block_rows] & spread[b][block_cols]
+                    repeated = np.flatnonzero(repeated)
+                    pairs = ids[b][block_rows[repeated]] * len(key_ids)
+                    pairs += ids[b][block_cols[repeated]]
+                    keep = np.ones(len(block_rows), dtype=bool)
+                    for position, pair in zip(repeated, pairs.tolist()):
+                        keep[position] = pair not in seen
+                        seen.add(pair)
+                    block_rows, block_cols = block_rows[keep], block_cols[keep]
+                yield b, (block_rows, block_cols)
+
+    total = None
+    if count:
+        total = sum(len(block_rows) for _, (block_rows, _) in blocks())
+        print("Candidate questions:", total)
+    chosen = None
+    if count and count < total:
+        rng = np.random.default_rng(seed)
+        chosen = np.sort(rng.choice(total, count, replace=False))
+
+    empty = np.empty(0, dtype=np.int64)
+    bucket_ids, rows, cols = [empty], [empty], [empty]
+    offset = 0
+    for b, (block_rows, block_cols) in blocks():
+        if chosen is not None:
+            # the chosen candidates in this block, as positions in it
+            start, stop = np.searchsorted(chosen, [offset, offset + len(block_rows)])
+            picked = chosen[start:stop] - offset
+            offset += len(block_rows)
+            block_rows, block_cols = block_rows[picked], block_cols[picked]
+        bucket_ids.append(np.full(len(block_rows), b, dtype=np.int64))
+        rows.append(block_rows)
+        cols.append(block_cols)
+    bucket_ids, rows, cols = (np.concatenate(x) for x in (bucket_ids, rows, cols))
+    if total is None:
+        print("Candidate questions:", len(rows))
+
+    questions = []
+    for b, i, j in zip(bucket_ids.tolist(), rows.tolist(), cols.tolist()):
+        bucket = buckets[b][1]
+        question = ratio_question(bucket[i], bucket[j])
+        questions.append(question)
+        keys.add(question.key())
+    return questions
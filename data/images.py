@@ -1,41 +1,162 @@
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable
 import requests
 
+import profiling
+
 URL = "https://en.wikipedia.org/w/api.php"
+USER_AGENT = "fermidle-data (https://github.com/efergus/fermidle)"
 
+DAY = 24 * 60 * 60
 
-def image_search(thing: str):
-    session = requests.session()
-
-    params = {
-        "action": "query",
-        "format": "json",
-        "list": "search",
-        "srlimit": 3,
-        "srsearch": thing,
-    }
-
-    try:
-        response = session.get(url=URL, params=params)
-        data = response.json()
-        results = data["query"]["search"]
-        pageids = [str(result["pageid"]) for result in results]
-
-        data = {}
-        for pageid in pageids:
-            params = {
-                "action": "query",
-                "format": "json",
-                "prop": "pageimages|info",
-                "pithumbsize": 400,
-                "pilimit": 2,
-                "pageids": pageid,
-                "inprop": "url",
-            }
-            response = session.get(url=URL, params=params)
+
+class ImageSearcher:
+    """
+    Wikipedia thumbnail lookups sharing one pooled session, run a few at a
+    time and spaced at least min_interval seconds apart
+    """
+
+    def __init__(self, url=URL, workers=4, min_interval=0.1):
+        self.url = url
+        self.workers = workers
+        self.min_interval = min_interval
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.next_request = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_request - now
+            self.next_request = max(now, self.next_request) + self.min_interval
+        if delay > 0:
+            time.sleep(delay)
+
+    def search(self, thing: str):
+        """
+        The thumbnail of the best Wikipedia match for thing. Returns "" if
+        there is none, or None if the search failed.
+        """
+        # one request both searches and fetches the thumbnails of the results
+        params = {
+            "action": "query",
+            "format": "json",
+            "generator": "search",
+            "gsrlimit": 3,
+            "gsrsearch": thing,
+            "prop": "pageimages",
+            "piprop": "thumbnail",
+            "pithumbsize": 400,
+            "pilimit": 3,
+        }
+        try:
+            self.wait()
+            response = self.session.get(url=self.url, params=params, timeout=30)
             data = response.json()
-            page = data["query"]["pages"][pageid]
-            if "thumbnail" in page:
-                return page["thumbnail"]["source"]
-    except Exception as e:
-        print(e)
-        return
+            pages = data.get("query", {}).get("pages", {}).values()
+            # keep the search order, like checking each result in turn
+            for page in sorted(pages, key=lambda page: page.get("index", 0)):
+                if "thumbnail" in page:
+                    return page["thumbnail"]["source"]
+        except Exception as e:
+            print(e)
+            return
+        return ""
+
+    def search_all(self, things: Iterable[str]) -> Dict[str, str | None]:
+        """Search for every thing, stopping early on KeyboardInterrupt"""
+        results = {}
+        with ThreadPoolExecutor(self.workers) as executor:
+            futures = {executor.submit(self.search, thing): thing for thing in things}
+            try:
+                for future in as_completed(futures):
+                    results[futures[future]] = future.result()
+            except KeyboardInterrupt:
+                executor.shutdown(wait=False, cancel_futures=True)
+        return results
+
+
+def image_search(thing: str):
+    return ImageSearcher(workers=1).search(thing)
+
+
+def normalize_query(query: str):
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+
+class ImageCache:
+    """
+    Image search results stored in SQLite by normalized query. Searches that
+    found nothing are kept too, but expire sooner.
+    """
+
+    def __init__(self, path="images.sqlite", ttl=180 * DAY, negative_ttl=7 * DAY):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS images"
+            " (query TEXT PRIMARY KEY, url TEXT NOT NULL, searched REAL NOT NULL)"
+        )
+
+    def get(self, query: str):
+        """The cached url ("" for no image), or None if it isn't cached"""
+        row = self.connection.execute(
+            "SELECT url, searched FROM images WHERE query = ?",
+            (normalize_query(query),),
+        ).fetchone()
+        if not row:
+            return None
+        url, searched = row
+        ttl = self.ttl if url else self.negative_ttl
+        if time.time() - searched > ttl:
+            return None
+        return url
+
+    def set(self, query: str, url: str):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO images VALUES (?, ?, ?)",
+                (normalize_query(query), url, time.time()),
+            )
+
+
+def cached_image_search(thing: str, cache: ImageCache, refresh=False):
+    return cached_image_search_all([thing], cache, refresh=refresh).get(thing)
+
+
+def cached_image_search_all(
+    things: Iterable[str],
+    cache: ImageCache,
+    searcher: ImageSearcher = None,
+    refresh=False,
+) -> Dict[str, str | None]:
+    """Look up every thing in the cache, and search for the rest together"""
+    results = {}
+    pending = []
+    for thing in things:
+        url = None if refresh else cache.get(thing)
+        if url is None:
+            pending.append(thing)
+        else:
+            results[thing] = url
+    profiling.count("cached", len(results))
+    if pending:
+        profiling.count("searches", len(pending))
+        searcher = searcher or ImageSearcher()
+        found = searcher.search_all(pending)
+        for thing, url in found.items():
+            # failed searches aren't cached so they are retried next time
+            if url is not None:
+                cache.set(thing, url)
+        results.update(found)
+    return results
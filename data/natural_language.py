@@ -1,12 +1,21 @@
+from __future__ import annotations
 from abc import ABC, abstractmethod
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
+import hashlib
 import json
 import random
-from typing import List
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Tuple
 from dotenv import load_dotenv
 
 import openai
 
+import profiling
+from rules import RuleNamer
 from value import Value
 
 # Load environment variables
@@ -22,20 +31,61 @@ OPENAI_MODELS = {
 }
 
 
+class RetryableCompletionError(Exception):
+    """A completion failed in a way that may work if it is tried again"""
+
+
 class CompletionContext(ABC):
     @abstractmethod
     def complete(self, messages: List[dict]):
         pass
 
+    def complete_retrying(self, messages: List[dict], retries=5, backoff=1.0):
+        """Complete, waiting exponentially longer after each retryable error"""
+        for attempt in range(retries + 1):
+            try:
+                return self.complete(messages)
+            except RetryableCompletionError as e:
+                if attempt == retries:
+                    print(f"Giving up after {retries} retries: {e}")
+                    return ""
+                time.sleep(backoff * 2**attempt)
+
+    def complete_many(
+        self, conversations: List[List[dict]], workers=1, retries=5, backoff=1.0
+    ) -> Iterator[str]:
+        """
+        Complete every conversation with up to workers in flight at once,
+        yielding the responses in the same order as the conversations
+        """
+        if workers <= 1:
+            for messages in conversations:
+                yield self.complete_retrying(messages, retries, backoff)
+            return
+        executor = ThreadPoolExecutor(workers)
+        try:
+            yield from executor.map(
+                lambda messages: self.complete_retrying(messages, retries, backoff),
+                conversations,
+            )
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
 
 @dataclass
 class OpenAICompletionContext(CompletionContext):
     model: str = "3"
     live: bool = False
-    openai_client: openai.OpenAI = field(init=False)
+    openai_client: openai.OpenAI | None = field(init=False, default=None)
+    lock: threading.Lock = field(init=False, default_factory=threading.Lock)
 
-    def __post_init__(self):
-        self.client = openai.OpenAI()
+    @property
+    def client(self):
+        """Made on first use, so runs that need no completions need no API key"""
+        with self.lock:
+            if self.openai_client is None:
+                self.openai_client = openai.OpenAI()
+            return self.openai_client
 
     def complete(self, messages: List[dict]):
         """Complete the current message using OpenAI."""
@@ -53,6 +103,12 @@ class OpenAICompletionContext(CompletionContext):
                 response += content
                 if self.live:
                     print(content, end="", flush=True)
+        except (
+            openai.RateLimitError,
+            openai.APIConnectionError,
+            openai.InternalServerError,
+        ) as e:
+            raise RetryableCompletionError(e) from e
         except openai.OpenAIError as e:
             print(f"An API error occurred: {e}")
         return response
@@ -64,11 +120,224 @@ class ManualCompletionContext(CompletionContext):
         return response
 
 
+class CachedCompletionContext(CompletionContext):
+    """
+    Responses of another context stored in SQLite by a hash of the model and
+    the full message list. The least recently used responses are evicted
+    once the cache holds more than max_bytes. Without a context (but with the
+    model it was filled with), prompts that aren't cached get an empty
+    response, which replays a cache offline.
+    """
+
+    def __init__(
+        self,
+        context: CompletionContext | None,
+        path="completions.sqlite",
+        max_bytes=64 * 1024 * 1024,
+        model: str | None = None,
+    ):
+        self.context = context
+        model = model or getattr(context, "model", type(context).__name__)
+        # by the model the alias stands for, so remapping it misses the cache
+        self.model = OPENAI_MODELS.get(model, model)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS completions (digest TEXT PRIMARY KEY,"
+            " response TEXT NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)"
+        )
+        (self.size,) = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM completions"
+        ).fetchone()
+
+    def digest(self, messages: List[dict]):
+        prompt = json.dumps({"model": self.model, "messages": messages}, sort_keys=True)
+        return hashlib.sha256(prompt.encode()).hexdigest()
+
+    def complete(self, messages: List[dict]):
+        digest = self.digest(messages)
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT response FROM completions WHERE digest = ?", (digest,)
+            ).fetchone()
+            if row:
+                self.hits += 1
+                self.connection.execute(
+                    "UPDATE completions SET used = ? WHERE digest = ?",
+                    (time.time(), digest),
+                )
+                return row[0]
+            self.misses += 1
+        if not self.context:
+            return ""
+        response = self.context.complete(messages)
+        # empty responses are failures, so they aren't worth keeping
+        if response:
+            self.store(digest, response)
+        return response
+
+    def store(self, digest: str, response: str):
+        size = len(digest) + len(response.encode())
+        with self.lock, self.connection:
+            replaced = self.connection.execute(
+                "SELECT size FROM completions WHERE digest = ?", (digest,)
+            ).fetchone()
+            if replaced:
+                self.size -= replaced[0]
+            self.connection.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+                (digest, response, size, time.time()),
+            )
+            self.size += size
+            while self.size > self.max_bytes:
+                oldest = self.connection.execute(
+                    "SELECT digest, size FROM completions ORDER BY used LIMIT 1"
+                ).fetchone()
+                if not oldest:
+                    break
+                self.connection.execute(
+                    "DELETE FROM completions WHERE digest = ?", (oldest[0],)
+                )
+                self.size -= oldest[1]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "bytes": self.size}
+
+
+def estimate_tokens(messages: List[dict]):
+    """A rough token count, about four characters per token plus overhead"""
+    return sum(len(message["content"]) // 4 + 4 for message in messages)
+
+
+class ExampleIndex:
+    """
+    Named values indexed by measurement, specifier and tag, to pick the
+    examples most similar to the values being named
+    """
+
+    def __init__(self, named: List[Value], k: int = 12, max_tokens: int = 600):
+        self.k = k
+        self.max_tokens = max_tokens
+        # best examples first, so ties go to the higher quality one
+        self.named = sorted(named, key=lambda value: value.quality, reverse=True)
+        self.index: Dict[Tuple[str, str], List[int]] = defaultdict(list)
+        for i, value in enumerate(self.named):
+            for feature in self.features(value):
+                self.index[feature].append(i)
+
+    @staticmethod
+    def features(value: Value):
+        features = [("measurement", value.measurement)]
+        if value.specifier:
+            features.append(("specifier", value.specifier))
+            features.extend(("word", word) for word in value.specifier.split())
+        features.extend(("tag", tag) for tag in value.tags)
+        return features
+
+    WEIGHTS = {"measurement": 4, "specifier": 3, "word": 1, "tag": 2}
+
+    def select(self, values: List[Value]) -> List[Value]:
+        """
+        The k examples with the most features in common with any of values,
+        as long as their messages fit in max_tokens
+        """
+        scores = defaultdict(int)
+        for value in values:
+            for feature in set(self.features(value)):
+                for i in self.index.get(feature, []):
+                    scores[i] += self.WEIGHTS[feature[0]]
+        # fall back on the best examples overall when few are similar
+        ranked = sorted(scores, key=lambda i: (-scores[i], i))
+        ranked += [i for i in range(min(len(self.named), self.k)) if i not in scores]
+        examples = []
+        tokens = 0
+        for i in ranked:
+            example = self.named[i]
+            cost = estimate_tokens(example.to_messages())
+            if tokens + cost > self.max_tokens:
+                continue
+            examples.append(example)
+            tokens += cost
+            if len(examples) >= self.k:
+                break
+        return examples
+
+
 SYSTEM = "Convert data to what you'd call it. Don't include any values"
 START_MESSAGE = {
     "role": "system",
     "content": SYSTEM,
 }
+BATCH_MESSAGE = {
+    "role": "system",
+    "content": SYSTEM
+    + ". Each item has an id. Reply with only a JSON object mapping every id"
+    " to its name.",
+}
+
+
+def batch_content(values: List[Value]):
+    return "\n\n".join(
+        f"id: {i}\n{value.to_string()}" for i, value in enumerate(values, 1)
+    )
+
+
+def batch_messages(values: List[Value], examples: List[Value]):
+    """One request naming all of values, with the examples as one batch"""
+    messages = [BATCH_MESSAGE]
+    if examples:
+        names = {str(i): example.name for i, example in enumerate(examples, 1)}
+        messages.append({"role": "user", "content": batch_content(examples)})
+        messages.append({"role": "assistant", "content": json.dumps(names)})
+    messages.append({"role": "user", "content": batch_content(values)})
+    return messages
+
+
+def parse_batch(response: str, count: int) -> Dict[int, str]:
+    """The names of a batch response by id, leaving out anything invalid"""
+    start, end = response.find("{"), response.rfind("}")
+    try:
+        data = json.loads(response[start : end + 1])
+    except ValueError:
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    names = {}
+    for i in range(1, count + 1):
+        name = data.get(str(i))
+        if isinstance(name, str) and name.strip():
+            names[i] = name.strip()
+    return names
+
+
+def complete_batches(
+    context: CompletionContext,
+    values: List[Value],
+    examples: Callable[[List[Value]], List[Value]],
+    single_messages: Callable[[Value], List[dict]],
+    batch_size: int,
+    workers: int = 1,
+) -> Iterator[str]:
+    """
+    Name values batch_size at a time, yielding names in the order of values.
+    Values missing from a batch response are asked for on their own.
+    """
+    batches = [values[i : i + batch_size] for i in range(0, len(values), batch_size)]
+    responses = context.complete_many(
+        [batch_messages(batch, examples(batch)) for batch in batches], workers=workers
+    )
+    try:
+        for batch, response in zip(batches, responses):
+            names = parse_batch(response, len(batch))
+            if len(names) < len(batch):
+                print(f"Batch named {len(names)}/{len(batch)}, asking for the rest")
+            for i, value in enumerate(batch, 1):
+                yield names.get(i) or context.complete_retrying(single_messages(value))
+    finally:
+        responses.close()
 
 
 def create_names(
@@ -77,8 +346,23 @@ def create_names(
     start_message=START_MESSAGE,
     manual_quality=False,
     manual=False,
+    context: CompletionContext = None,
+    workers: int = 1,
+    batch_size: int = 1,
+    example_tokens: int = 0,
+    rules: bool = False,
 ):
-    context = ManualCompletionContext() if manual else OpenAICompletionContext()
+    """
+    Name every value without a name. The examples are the sample_size best
+    named values, or with example_tokens, the sample_size most similar named
+    values to each value that fit in that many prompt tokens. With rules,
+    values a RuleNamer can name are named without asking the context.
+    """
+    if not context:
+        context = ManualCompletionContext() if manual else OpenAICompletionContext()
+    if manual or manual_quality:
+        workers = 1
+        batch_size = 1
     randomized_values = values.copy()
     random.shuffle(randomized_values)
     all_named = [value for value in randomized_values if value.name]
@@ -89,17 +373,50 @@ def create_names(
     named_example_messages = [
         message for example in named_examples for message in example.to_messages()
     ]
-    for message in named_example_messages:
-        print(json.dumps(message, indent=2))
-    try:
-        for value in randomized_values:
-            if value.name:
-                continue
+    if not example_tokens:
+        for message in named_example_messages:
+            print(json.dumps(message, indent=2))
+    unnamed = [value for value in randomized_values if not value.name]
+    rule_namer = RuleNamer(all_named) if rules else None
+    if rule_namer:
+        for value in unnamed:
+            value.name = rule_namer.name(value) or ""
+        named_by_rules = [value for value in unnamed if value.name]
+        unnamed = [value for value in unnamed if not value.name]
+        profiling.count("rule names", len(named_by_rules))
+        print("To generate after rules:", len(unnamed))
+    example_index = None
+    if example_tokens and unnamed:
+        example_index = ExampleIndex(all_named, sample_size, example_tokens)
+
+    def examples(values: List[Value]):
+        return example_index.select(values) if example_tokens else named_examples
 
+    def single_messages(value: Value):
+        example_messages = named_example_messages
+        if example_tokens:
+            example_messages = [
+                message
+                for example in examples([value])
+                for message in example.to_messages()
+            ]
+        return [start_message, *example_messages, *value.to_messages()]
+
+    if batch_size > 1:
+        names = complete_batches(
+            context, unnamed, examples, single_messages, batch_size, workers
+        )
+    else:
+        names = context.complete_many(
+            [single_messages(value) for value in unnamed], workers=workers
+        )
+    try:
+        for value in unnamed:
             messages = value.to_messages()
             print()
             print(messages[-1]["content"])
-            name = context.complete([START_MESSAGE, *named_example_messages, *messages])
+            name = next(names)
+            profiling.count("completions")
             print(name)
             if manual:
                 value.quality = 1.0
@@ -109,4 +426,11 @@ def create_names(
             value.name = name
     except KeyboardInterrupt:
         pass
+    finally:
+        names.close()
+    if rule_namer:
+        print("Rules:", rule_namer.report())
+    if isinstance(context, CachedCompletionContext):
+        print("Completion cache:", context.stats())
+        profiling.count("cache hits", context.hits)
     return values
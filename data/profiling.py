@@ -0,0 +1,117 @@
+from __future__ import annotations
+from collections import defaultdict
+from contextlib import contextmanager
+import cProfile
+import json
+import resource
+import sys
+import time
+import tracemalloc
+from typing import Dict, List
+
+from data import now
+
+
+def max_rss_bytes():
+    """The most memory the process has held, which macOS gives in bytes"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class Profiler:
+    """
+    Wall time, entries, the process's max RSS so far and counters for each
+    named stage of a run, and the peak traced memory if tracing memory.
+    Stages can nest, in which case the outer stage includes the inner one.
+    Does nothing until enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stages: Dict[str, Dict] = {}
+        self.stack: List[Dict] = []
+        self.cprofile_stage = ""
+        self.cprofile = None
+        self.memory = False
+
+    def enable(self, cprofile_stage="", memory=False):
+        self.enabled = True
+        self.started = time.perf_counter()
+        self.cprofile_stage = cprofile_stage
+        if cprofile_stage:
+            self.cprofile = cProfile.Profile()
+        # tracing every allocation slows stages down, and the ones that
+        # allocate most the most, so it skews their times
+        self.memory = memory
+        if memory:
+            tracemalloc.start()
+
+    def record(self, name: str):
+        if name not in self.stages:
+            self.stages[name] = {
+                "calls": 0,
+                "seconds": 0.0,
+                "max_rss_bytes": 0,
+                "counts": defaultdict(int),
+            }
+        return self.stages[name]
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        # the peak is reset for each stage, so keep the outer one's so far
+        if self.memory:
+            if self.stack:
+                self.stack[-1]["peak"] = max(
+                    self.stack[-1]["peak"], tracemalloc.get_traced_memory()[1]
+                )
+            tracemalloc.reset_peak()
+        frame = {"name": name, "peak": 0, "start": time.perf_counter()}
+        self.stack.append(frame)
+        profiled = name == self.cprofile_stage and self.cprofile
+        if profiled:
+            self.cprofile.enable()
+        try:
+            yield
+        finally:
+            if profiled:
+                self.cprofile.disable()
+            seconds = time.perf_counter() - frame["start"]
+            self.stack.pop()
+            record = self.record(name)
+            record["calls"] += 1
+            record["seconds"] += seconds
+            record["max_rss_bytes"] = max_rss_bytes()
+            if self.memory:
+                peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+                if self.stack:
+                    self.stack[-1]["peak"] = max(self.stack[-1]["peak"], peak)
+                record["peak_bytes"] = max(record.get("peak_bytes", 0), peak)
+
+    def count(self, counter: str, n=1):
+        """Add n to a counter of the innermost stage"""
+        if self.enabled and self.stack:
+            self.record(self.stack[-1]["name"])["counts"][counter] += n
+
+    def trace(self):
+        return {
+            "created": now(),
+            "argv": sys.argv,
+            "seconds": time.perf_counter() - self.started,
+            "max_rss_bytes": max_rss_bytes(),
+            "stages": self.stages,
+        }
+
+    def save(self, path: str):
+        with open(path, "w") as file:
+            json.dump(self.trace(), file, indent=2)
+        if self.cprofile:
+            self.cprofile.dump_stats(f"{path}.{self.cprofile_stage}.prof")
+
+
+# The run's profiler, so any module can mark its stages
+profiler = Profiler()
+stage = profiler.stage
+count = profiler.count
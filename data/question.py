@@ -1,13 +1,16 @@
+from __future__ import annotations
 from dataclasses import dataclass
-from typing import Dict, List
+import json
+import math
+from typing import Callable, Dict, List, Tuple
 from units import scientific
 
 from value import Value
-from data import default, now
+from data import default, intern, now
 import uuid
 
 
-@dataclass
+@dataclass(slots=True)
 class Question:
     values: List[Value]
     question: str = ""
@@ -21,15 +24,22 @@ class Question:
     def __post_init__(self):
         if not self.measurement:
             self.measurement = self.values[0].measurement
+        self.measurement = intern(self.measurement)
+        self.generated = intern(self.generated)
+        self.style = intern(self.style)
         if not self.qid:
             self.qid = uuid.uuid4().hex
 
     def key(self):
         return (self.style, *[value.key() for value in self.values])
 
-    def serialize(self):
+    def serialize(self, position: Callable[[Value], int] | None = None):
+        """With position, values are referred to by their position in a table"""
         return {
-            "values": [value.serialize() for value in self.values],
+            "values": [
+                position(value) if position else value.serialize()
+                for value in self.values
+            ],
             "question": self.question,
             "answer": self.answer,
             "measurement": self.measurement,
@@ -40,9 +50,13 @@ class Question:
         }
 
     @staticmethod
-    def deserialize(data: Dict):
+    def deserialize(data: Dict, values: List[Value] | None = None):
+        """With values, data refers to its values by position, and they are shared"""
         return Question(
-            [Value.deserialize(value) for value in data["values"]],
+            [
+                values[value] if values is not None else Value.deserialize(value)
+                for value in data["values"]
+            ],
             answer=data["answer"],
             question=data["question"].removeprefix("Q: "),
             measurement=data.get("measurement", ""),
@@ -52,6 +66,18 @@ class Question:
             qid=data.get("id", ""),
         )
 
+    def difficulty(self) -> float:
+        """
+        How hard the question is to use as a hint, as question_difficulty in
+        src/lib/data/questions.ts works it out from the exported values
+        """
+        sizes = [
+            abs(math.log10(float(value.value.serialize().split(" ")[0])))
+            for value in self.values
+        ]
+        magnitude = abs(math.log10(self.answer))
+        return sum(sizes) * max(math.log10(magnitude) if magnitude else 1, 1)
+
     def to_messages(self, include_question=True):
         messages = []
         user_content = self.to_prompt()
@@ -59,3 +85,33 @@ class Question:
         if include_question and self.question:
             messages.append({"role": "assistant", "content": f"Q: {self.question}"})
         return messages
+
+
+def serialize_normalized(questions: List[Question]) -> Dict:
+    """
+    The questions with a table of their values, which the questions refer to
+    by position. Values that serialize the same are stored once, so a value
+    that changed between runs keeps both its old and new entries.
+    """
+    table: List[Dict] = []
+    entries: Dict[str, int] = {}
+    positions: Dict[int, int] = {}
+
+    def position(value: Value) -> int:
+        if id(value) not in positions:
+            data = value.serialize()
+            entry = json.dumps(data)
+            if entry not in entries:
+                entries[entry] = len(table)
+                table.append(data)
+            positions[id(value)] = entries[entry]
+        return positions[id(value)]
+
+    serialized = [question.serialize(position) for question in questions]
+    return {"values": table, "questions": serialized}
+
+
+def deserialize_normalized(data: Dict) -> List[Question]:
+    """Questions from serialize_normalized, sharing one Value for each entry"""
+    values = [Value.deserialize(value) for value in data["values"]]
+    return [Question.deserialize(question, values) for question in data["questions"]]
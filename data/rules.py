@@ -0,0 +1,148 @@
+from __future__ import annotations
+from collections import Counter
+import re
+from typing import Dict, List
+
+from value import Value
+
+# Measurements whose values, without a specifier, are named after them
+MEASUREMENT_NOUNS = {
+    "mass": "mass",
+    "density": "density",
+    "surface area": "surface area",
+    "volume": "volume",
+    "frequency": "frequency",
+    "loudness": "loudness",
+}
+
+# Specifiers that can be used as the name as is
+SPECIFIER_NOUNS = {
+    "age",
+    "boiling point",
+    "circumference",
+    "cruise speed",
+    "density",
+    "depth",
+    "diameter",
+    "escape velocity",
+    "height",
+    "length",
+    "lifespan",
+    "mass",
+    "melting point",
+    "orbital speed",
+    "period",
+    "population",
+    "radius",
+    "shoreline length",
+    "speed",
+    "surface area",
+    "thickness",
+    "volume",
+    "wavelength",
+    "width",
+    "wing area",
+    "wingspan",
+}
+
+QUALIFIERS = {"avg": "average", "mean": "average", "max": "maximum", "min": "minimum"}
+
+
+# Countries that take "the" without it showing in their name
+COUNTRIES_WITH_THE = {
+    "bahamas",
+    "comoros",
+    "gambia",
+    "maldives",
+    "netherlands",
+    "philippines",
+    "seychelles",
+    "uk",
+    "us",
+    "usa",
+    "uae",
+    "vatican",
+    "vatican city",
+}
+
+
+def country_phrase(country: str):
+    """Country names that read as plurals or descriptions take "the" """
+    words = country.split()
+    if (
+        country.lower() in COUNTRIES_WITH_THE
+        or words[0] in ("United", "Central")
+        or any(word in ("Republic", "Kingdom", "Islands") for word in words)
+    ):
+        return f"the {country}"
+    return country
+
+
+class RuleNamer:
+    """
+    Names values from templates, like "The mass of the Moon", when both the
+    noun and the way to write the thing are known. The noun comes from the
+    measurement or specifier; the thing from a name it already has in the
+    same form, or from its being a country. Everything else is left for a
+    CompletionContext.
+
+    Generated names are only trusted for a thing once two of them agree.
+    """
+
+    def __init__(self, named: List[Value] = ()):
+        self.phrases: Dict[str, str] = {}
+        self.seen: Dict[str, Counter] = {}
+        self.hits = Counter()
+        for value in named:
+            self.learn(value)
+
+    @staticmethod
+    def noun(value: Value):
+        if not value.specifier:
+            return MEASUREMENT_NOUNS.get(value.measurement)
+        qualifier, _, rest = value.specifier.partition(" ")
+        if qualifier in QUALIFIERS:
+            rest = rest or value.measurement
+            if rest in SPECIFIER_NOUNS:
+                return f"{QUALIFIERS[qualifier]} {rest}"
+            return None
+        if value.specifier in SPECIFIER_NOUNS:
+            return value.specifier
+        return None
+
+    def learn(self, value: Value):
+        """Remember how value's name writes its thing, if it follows the template"""
+        noun = self.noun(value)
+        if not noun or not value.name:
+            return
+        match = re.fullmatch(f"The {re.escape(noun)} of (.+?)\\.?", value.name.strip())
+        if not match:
+            return
+        seen = self.seen.setdefault(value.thing, Counter())
+        seen[match.group(1)] += 2 if value.quality > 0 else 1
+        (phrase, count), *rest = seen.most_common()
+        if count >= 2 and not rest:
+            self.phrases[value.thing] = phrase
+        else:
+            self.phrases.pop(value.thing, None)
+
+    def name(self, value: Value):
+        """The name of value, or None if it needs a person or a model"""
+        noun = self.noun(value)
+        if not noun:
+            self.hits["unknown noun"] += 1
+            return None
+        if value.thing in self.phrases:
+            rule = "known thing"
+            phrase = self.phrases[value.thing]
+        elif "country" in value.tags and value.thing.strip():
+            rule = "country"
+            phrase = country_phrase(value.thing.strip())
+        else:
+            self.hits["unknown thing"] += 1
+            return None
+        self.hits[rule] += 1
+        return f"The {noun} of {phrase}"
+
+    def report(self):
+        return dict(self.hits.most_common())
@@ -0,0 +1,230 @@
+from __future__ import annotations
+from collections import Counter, defaultdict
+import hashlib
+import json
+import os
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+
+def as_key(data):
+    """Turn the lists of a key read from JSON back into tuples"""
+    if isinstance(data, list):
+        return tuple(map(as_key, data))
+    return data
+
+
+def numbered(keys: Iterable) -> Iterator[Tuple]:
+    """Records can share a key, so the nth copy of a key gets n in its key"""
+    counts = defaultdict(int)
+    for key in keys:
+        yield key, counts[key]
+        counts[key] += 1
+
+
+def digest(line: str):
+    return hashlib.blake2b(line.encode(), digest_size=8).hexdigest()
+
+
+# how json.dump(..., indent=2) separates the objects of an array
+ITEM_SEPARATOR = "\n  },\n  {"
+
+
+def item_text(record) -> str:
+    """A record as it is written in a JSON array by json.dump(..., indent=2)"""
+    return json.dumps(record, indent=2).replace("\n", "\n  ")
+
+
+def array_items(text: str) -> List[str]:
+    """
+    The text of each object of a JSON array written with indent=2, without
+    parsing them, so they can be written back as they are by join_items
+    """
+    if not text.strip() or text.strip() == "[]":
+        return []
+    if not (text.startswith("[\n  {\n") and text.endswith("\n  }\n]")):
+        return [item_text(record) for record in json.loads(text)]
+    parts = text[len("[\n  ") : -len("\n]")].split(ITEM_SEPARATOR)
+    # the separator takes the end of one object and the start of the next
+    last = len(parts) - 1
+    return ["{" * (n > 0) + part + "\n  }" * (n < last) for n, part in enumerate(parts)]
+
+
+def join_items(items: List[str]) -> str:
+    """The JSON array of the texts of item_text or array_items"""
+    if not items:
+        return "[]"
+    return "[\n  " + ",\n  ".join(items) + "\n]"
+
+
+class JsonlStore:
+    """
+    Records kept in an append-only JSON Lines file. Every line holds a key and
+    a record (or null once the record is deleted), and the last line of a key
+    wins. A second, also append-only, file indexes the byte offset and digest
+    of the latest line of every key, so unchanged records are never rewritten.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        key: Callable,
+        serialize: Callable,
+        deserialize: Callable,
+        compact_ratio: float = 1.0,
+    ):
+        self.path = path
+        self.index_path = f"{path}.index"
+        self.key = key
+        self.serialize = serialize
+        self.deserialize = deserialize
+        # compact once there are this many stale lines per live record
+        self.compact_ratio = compact_ratio
+        self.entries: Dict[Tuple, Tuple[int, str]] = {}
+        self.lines = 0
+        self.last = None
+        self.load_index()
+
+    def load_index(self):
+        self.entries = {}
+        self.lines = 0
+        self.last = None
+        try:
+            with open(self.index_path, "r") as index:
+                # one document parses much faster than a line at a time
+                rows = json.loads(f"[{','.join(index.read().splitlines())}]")
+            for row in rows:
+                self.apply(*row)
+        except (FileNotFoundError, json.JSONDecodeError, TypeError):
+            return self.reindex()
+        if not self.index_valid():
+            self.reindex()
+
+    def apply(self, key, offset: int, line_digest: str | None):
+        key = as_key(key)
+        self.lines += 1
+        self.last = (key, offset)
+        if line_digest is None:
+            self.entries.pop(key, None)
+        else:
+            self.entries[key] = (offset, line_digest)
+
+    def index_valid(self):
+        """Check that the index ends exactly where the data file does"""
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if not self.last:
+            return size == 0
+        key, offset = self.last
+        with open(self.path, "rb") as file:
+            file.seek(offset)
+            line = file.readline()
+            return file.tell() == size and as_key(json.loads(line)["key"]) == key
+
+    def reindex(self):
+        """Rebuild the index from the data file"""
+        self.entries = {}
+        self.lines = 0
+        self.last = None
+        rows = []
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as file:
+                offset = 0
+                for line in file:
+                    data = json.loads(line)
+                    record = data["record"]
+                    line_digest = None
+                    if record is not None:
+                        line_digest = digest(json.dumps(record))
+                    rows.append([data["key"], offset, line_digest])
+                    self.apply(data["key"], offset, line_digest)
+                    offset += len(line)
+        with open(self.index_path, "w") as index:
+            for row in rows:
+                index.write(json.dumps(row) + "\n")
+
+    def keys(self):
+        return self.entries.keys()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def raw(self, keys: Iterable[Tuple] | None = None) -> List[Dict]:
+        """
+        The serialized live records, in the order their keys were added, or
+        the ones of the given keys
+        """
+        entries = self.entries.values()
+        if keys is not None:
+            entries = [self.entries[key] for key in keys]
+        if not entries:
+            return []
+        with open(self.path, "rb") as file:
+            data = file.read()
+        records = []
+        for offset, _ in entries:
+            end = data.index(b"\n", offset)
+            records.append(json.loads(data[offset:end])["record"])
+        return records
+
+    def load(self) -> List:
+        if not self.entries:
+            return []
+        return [self.deserialize(record) for record in self.raw()]
+
+    def get(self, key):
+        offset, _ = self.entries[key]
+        with open(self.path, "rb") as file:
+            file.seek(offset)
+            return self.deserialize(json.loads(file.readline())["record"])
+
+    def keyed(self, records: Iterable) -> Iterable[Tuple[Tuple, Dict | None]]:
+        records = list(records)
+        keys = numbered(self.key(record) for record in records)
+        return zip(keys, map(self.serialize, records))
+
+    def load_keyed(self) -> Dict[Tuple, object]:
+        """The records by their key in the store"""
+        return dict(zip(self.keys(), self.load()))
+
+    def write(self, records: Iterable, delete: Iterable[Tuple] = ()) -> int:
+        """Append the records that changed, and delete the given keys"""
+        changes = []
+        for key, record in self.keyed(records):
+            line = json.dumps(record)
+            line_digest = digest(line)
+            if self.entries.get(key, (None, None))[1] != line_digest:
+                changes.append((key, line, line_digest))
+        changes.extend((key, "null", None) for key in delete if key in self.entries)
+        if not changes:
+            return 0
+        with open(self.path, "ab") as file, open(self.index_path, "a") as index:
+            for key, line, line_digest in changes:
+                offset = file.tell()
+                line = f'{{"key": {json.dumps(key)}, "record": {line}}}\n'
+                file.write(line.encode())
+                index.write(json.dumps([key, offset, line_digest]) + "\n")
+                self.apply(key, offset, line_digest)
+        stale = self.lines - len(self.entries)
+        if stale > self.compact_ratio * max(len(self.entries), 1):
+            self.compact()
+        return len(changes)
+
+    def replace(self, records: List) -> int:
+        """Make the store hold exactly these records"""
+        counts = Counter(self.key(record) for record in records)
+        stale = [key for key in self.entries if key[1] >= counts[key[0]]]
+        return self.write(records, delete=stale)
+
+    def compact(self):
+        """Rewrite the data file with only the live lines"""
+        with open(self.path, "rb") as file:
+            data = file.read()
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "wb") as file:
+            for offset, _ in self.entries.values():
+                file.write(data[offset : data.index(b"\n", offset) + 1])
+        os.replace(temp_path, self.path)
+        self.reindex()
+
+    def export(self, file):
+        """Write the records as one JSON array, like save_values/save_questions"""
+        json.dump(self.raw() if self.entries else [], file, indent=2)
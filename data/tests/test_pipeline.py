@@ -0,0 +1,412 @@
+from __future__ import annotations
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import random
+import re
+import threading
+from typing import List
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pytest
+
+from arrays import QuantityArray
+from images import ImageCache, ImageSearcher, cached_image_search_all
+import natural_language
+from natural_language import (
+    CachedCompletionContext,
+    CompletionContext,
+    RetryableCompletionError,
+    create_names,
+)
+import bench
+import bundles
+import clean
+import cli
+import generate
+import store
+from units import Quantity, parse_units
+from value import Value
+
+
+def record_store(path, **kwargs):
+    return store.JsonlStore(
+        str(path), lambda record: record["id"], dict, dict, **kwargs
+    )
+
+
+def test_store_round_trip(tmp_path):
+    """Random writes, replaces and reopenings load the same as a plain list"""
+    rng = random.Random(0)
+    path = tmp_path / "records.jsonl"
+    records = []
+    for step in range(200):
+        # ids repeat, so some records share a key
+        records = [
+            {"id": rng.randrange(20), "n": rng.randrange(5)}
+            for _ in range(rng.randrange(30))
+        ]
+        records_store = record_store(path, compact_ratio=rng.choice([0.5, 1, 4]))
+        records_store.replace(records)
+        assert record_store(path).load() == records_store.load()
+        assert sorted(records_store.load(), key=json.dumps) == sorted(
+            records, key=json.dumps
+        )
+
+
+def test_store_only_writes_changes(tmp_path):
+    path = tmp_path / "records.jsonl"
+    records = [{"id": i, "n": 0} for i in range(10)]
+    assert record_store(path).write(records) == 10
+    assert record_store(path).write(records) == 0
+    records[3]["n"] = 1
+    assert record_store(path).write(records) == 1
+    assert record_store(path).get((3, 0)) == {"id": 3, "n": 1}
+
+
+def test_store_compacts(tmp_path):
+    path = tmp_path / "records.jsonl"
+    records_store = record_store(path)
+    for n in range(5):
+        records_store.write([{"id": i, "n": n} for i in range(10)])
+    # each rewrite of every record leaves a stale line per record, which is
+    # more than compact_ratio allows, so the file only holds live lines
+    assert len(path.read_text().splitlines()) <= 20
+    assert record_store(path).load() == [{"id": i, "n": 4} for i in range(10)]
+
+
+def test_store_deletes(tmp_path):
+    path = tmp_path / "records.jsonl"
+    record_store(path).write([{"id": 1}, {"id": 1}, {"id": 2}])
+    assert record_store(path).replace([{"id": 1}]) == 2
+    assert record_store(path).load() == [{"id": 1}]
+    assert set(record_store(path).keys()) == {(1, 0)}
+
+
+@pytest.mark.parametrize(
+    "damage", [lambda text: text[: len(text) // 2], lambda text: "not json\n", ""]
+)
+def test_store_reindexes(tmp_path, damage):
+    path = tmp_path / "records.jsonl"
+    records = [{"id": i % 4, "n": i} for i in range(12)]
+    record_store(path).write(records)
+    index = tmp_path / "records.jsonl.index"
+    if damage:
+        index.write_text(damage(index.read_text()))
+    else:
+        index.unlink()
+    assert record_store(path).load() == records
+
+
+class Wikipedia(BaseHTTPRequestHandler):
+    """Answers searches like the Wikipedia API, failing for "broken" things"""
+
+    requests: List[str] = []
+
+    def do_GET(self):
+        thing = parse_qs(urlparse(self.path).query)["gsrsearch"][0]
+        Wikipedia.requests.append(thing)
+        if thing == "broken":
+            self.send_response(500)
+            self.end_headers()
+            self.wfile.write(b"oops")
+            return
+        pages = {}
+        if thing != "nothing":
+            pages = {
+                # the second result has an image, but the first is better
+                "2": {"index": 2, "thumbnail": {"source": f"https://img/{thing}/2"}},
+                "1": {"index": 1, "thumbnail": {"source": f"https://img/{thing}/1"}},
+            }
+        body = json.dumps({"query": {"pages": pages}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def wikipedia():
+    Wikipedia.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Wikipedia)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/w/api.php"
+    server.shutdown()
+    server.server_close()
+
+
+def test_image_searcher(wikipedia):
+    searcher = ImageSearcher(wikipedia, workers=3, min_interval=0)
+    things = ["Moon", "nothing", "broken", "Sun"]
+    assert searcher.search_all(things) == {
+        "Moon": "https://img/Moon/1",
+        "nothing": "",
+        "broken": None,
+        "Sun": "https://img/Sun/1",
+    }
+
+
+def test_cached_image_search(wikipedia, tmp_path):
+    cache = ImageCache(str(tmp_path / "images.sqlite"))
+    searcher = ImageSearcher(wikipedia, min_interval=0)
+    things = ["Moon", "nothing", "broken"]
+    first = cached_image_search_all(things, cache, searcher)
+    assert first == {"Moon": "https://img/Moon/1", "nothing": "", "broken": None}
+    Wikipedia.requests = []
+    assert cached_image_search_all(things, cache, searcher) == first
+    # only the failed search is tried again
+    assert Wikipedia.requests == ["broken"]
+
+
+class FakeCompletionContext(CompletionContext):
+    """
+    Names values after their thing. Batches leave out their last value, and
+    the first request of every conversation fails once if flaky.
+    """
+
+    def __init__(self, flaky=False):
+        self.flaky = flaky
+        self.failed = set()
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def complete(self, messages: List[dict]):
+        content = messages[-1]["content"]
+        with self.lock:
+            self.requests.append(content)
+            if self.flaky and content not in self.failed:
+                self.failed.add(content)
+                raise RetryableCompletionError("rate limited")
+        things = re.findall(r"^thing: (.*)$", content, re.MULTILINE)
+        if content.startswith("id: "):
+            names = {str(i): f"The size of {t}" for i, t in enumerate(things, 1)}
+            names.pop(str(len(things)))
+            return f"Sure! {json.dumps(names)}"
+        return f"The size of {things[0]}"
+
+
+def unnamed_values(count):
+    return [
+        Value(Quantity.from_str(f"{i + 1} m"), measurement="length", thing=f"Thing {i}")
+        for i in range(count)
+    ]
+
+
+@pytest.mark.parametrize("workers,batch_size", [(1, 1), (4, 1), (1, 3), (4, 3)])
+def test_create_names(workers, batch_size):
+    values = unnamed_values(10)
+    context = FakeCompletionContext()
+    create_names(values, context=context, workers=workers, batch_size=batch_size)
+    assert [value.name for value in values] == [
+        f"The size of Thing {i}" for i in range(10)
+    ]
+    batches = -(-10 // batch_size)
+    # every batch leaves out one value, which is asked for on its own
+    assert len(context.requests) == (10 if batch_size == 1 else 2 * batches)
+
+
+def test_complete_many_retries():
+    context = FakeCompletionContext(flaky=True)
+    conversations = [
+        [{"role": "user", "content": f"thing: Thing {i}"}] for i in range(5)
+    ]
+    names = list(context.complete_many(conversations, workers=2, backoff=0))
+    assert names == [f"The size of Thing {i}" for i in range(5)]
+    assert len(context.requests) == 10
+
+
+def test_replay_cached_names(tmp_path, monkeypatch):
+    path = str(tmp_path / "completions.sqlite")
+    values = unnamed_values(3)
+    cached = CachedCompletionContext(FakeCompletionContext(), path, model="3")
+    create_names(values, context=cached)
+    names = [value.name for value in values]
+    # the alias and the model it stands for share cached names
+    replayed = unnamed_values(4)
+    replay = CachedCompletionContext(None, path, model="gpt-3.5-turbo")
+    create_names(replayed, context=replay)
+    assert [value.name for value in replayed] == [*names, ""]
+    assert replay.stats()["hits"] == 3
+    monkeypatch.setitem(natural_language.OPENAI_MODELS, "3", "gpt-4")
+    remapped = unnamed_values(3)
+    create_names(remapped, context=CachedCompletionContext(None, path, model="3"))
+    assert [value.name for value in remapped] == ["", "", ""]
+
+
+def test_rules_need_no_api_key(monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    values = [
+        Value(Quantity.from_str("1e6 kg"), measurement="mass", thing=country)
+        for country in ("France", "Netherlands")
+    ]
+    for value in values:
+        value.tags = ["country"]
+    create_names(values, rules=True)
+    assert [value.name for value in values] == [
+        "The mass of France",
+        "The mass of the Netherlands",
+    ]
+
+
+def test_quantity_array_strings():
+    rng = np.random.default_rng(0)
+    values = rng.standard_normal(5000) * 10.0 ** rng.integers(-300, 300, 5000)
+    values = np.concatenate([values, [0.0, -2.0, 5e-324, 1e-5, 1e16, 123.456]])
+    units = parse_units("kg/m^3")
+    array = QuantityArray(values, units)
+    quantities = [Quantity(value, units) for value in values.tolist()]
+    assert array.to_string() == [quantity.to_string() for quantity in quantities]
+    # rounding the tiniest ones overflows the scale, as with Quantity
+    positive = QuantityArray(np.abs(values[np.abs(values) > 1e-300]), units)
+    assert positive.to_string(2) == [
+        quantity.to_string(2) for quantity in positive.quantities()
+    ]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_exhaustive_sample_with_shared_keys(seed):
+    # every thing has three lengths and two masses of "other", which share a
+    # key, and questions of the masses and lengths share their keys too
+    values = [
+        Value(
+            Quantity.from_str(f"{thing + 1}.{n}5 {unit}"),
+            name=f"Thing {thing}",
+            measurement=measurement,
+            thing=f"Thing {thing}",
+        )
+        for thing in range(4)
+        for measurement, unit in [("length", "m"), ("other", "m"), ("other", "kg")]
+        for n in range(2)
+    ]
+    everything = generate.exhaustive_questions(values, set(), 0)
+    assert len(everything) == len({question.key() for question in everything}) == 24
+    questions = generate.exhaustive_questions(values, set(), 20, seed=seed)
+    assert len({question.key() for question in questions}) == 20
+
+
+def test_hint_index_points_into_shards(tmp_path):
+    values = [
+        Value(
+            Quantity.from_str(f"{3 ** thing} m"),
+            name=f"Thing {thing}",
+            measurement="length",
+            thing=f"Thing {thing}",
+        )
+        for thing in range(6)
+    ]
+    questions = generate.exhaustive_questions(values, set(), 0)
+    manifest = bundles.write_bundles(
+        questions, str(tmp_path), days=3, per_day=2, start=date(2024, 1, 1)
+    )
+    hints = json.loads((tmp_path / manifest["hints"]).read_text())
+    shards = [
+        json.loads((tmp_path / shard["file"]).read_text())
+        for shard in manifest["shards"]
+    ]
+    assert hints["log_answers"] == sorted(hints["log_answers"])
+    for log_answer, difficulty, shard, position in zip(
+        hints["log_answers"], hints["difficulties"], hints["shards"], hints["positions"]
+    ):
+        assert shards[shard][position]["log_answer"] == log_answer
+        assert shards[shard][position]["difficulty"] == difficulty
+    listed = [i for bucket in hints["buckets"] for i in bucket["questions"]]
+    assert sorted(listed) == list(range(len(questions)))
+
+
+@pytest.mark.parametrize("suffix", [".json", ".jsonl", ".parquet"])
+def test_incremental_clean_matches_full(tmp_path, suffix, capsys):
+    """
+    After a row is edited and another removed, an incremental clean only
+    parses the rows of the edited thing, but writes the same values as a
+    full clean, with the names they had
+    """
+    lines = bench.synthetic_sheet(300, 0).split("\n")
+    # a second row for Thing 1, so the edited row shares keys with it
+    lines.append("\t".join(["Thing 1", "2 m3"] + [""] * (len(clean.COLUMNS) - 2)))
+    paths = [str(tmp_path / f"{name}{suffix}") for name in ("incremental", "full")]
+    for path in paths:
+        cli.clean_values(io.StringIO("\n".join(lines)), path, incremental=True)
+        values = cli.load_values(path)
+        for value in values:
+            value.name = f"{value.thing} {value.specifier}"
+        cli.write_values(values, path)
+    cells = lines[2].split("\t")
+    assert cells[0] == "Thing 1"
+    cells[1] = "7 m3"
+    lines[2] = "\t".join(cells)
+    del lines[5]
+    sheet = "\n".join(lines)
+
+    capsys.readouterr()
+    cli.clean_values(io.StringIO(sheet), paths[0], incremental=True)
+    assert "Rows reused: 298, parsed: 2" in capsys.readouterr().out
+    cli.clean_values(io.StringIO(sheet), paths[1])
+    incremental, full = (
+        [value.serialize() for value in cli.load_values(path)] for path in paths
+    )
+    for value in incremental + full:
+        value.pop("generated")
+    assert incremental == full
+    assert all(value["name"] for value in full if value["thing"] != "Thing 1")
+
+
+def sheet_values(things) -> List[dict]:
+    clean.alter_things(things)
+    values = [
+        value.serialize() for thing in things for value in clean.thing_values(thing)
+    ]
+    for value in values:
+        value.pop("generated")
+    return values
+
+
+def test_get_things_matches_by_row():
+    """The vectorized parse gives the same values as the row by row one"""
+    sheet = bench.synthetic_sheet(300, 0)
+    by_row = clean.get_things_by_row(clean.read_frame(io.StringIO(sheet)))
+    things = clean.get_things(clean.read_frame(io.StringIO(sheet)))
+    assert sheet_values(things) == sheet_values(by_row)
+
+
+def test_jobs_match_serial(tmp_path):
+    """
+    Cleaning in several processes writes the same values file, byte for
+    byte, as cleaning in one
+    """
+    sheet = bench.synthetic_sheet(300, 0)
+    path = str(tmp_path / "values.json")
+    cli.clean_values(io.StringIO(sheet), path)
+    with open(path, "rb") as file:
+        serial = file.read()
+    # generated times are kept from the serial run, so only parsing can differ
+    cli.clean_values(io.StringIO(sheet), path, jobs=2)
+    with open(path, "rb") as file:
+        assert file.read() == serial
+
+
+def test_normalized_questions_round_trip(tmp_path):
+    """
+    Normalized questions load the same as embedded ones, with one Value for
+    each entry of the table
+    """
+    random.seed(0)
+    values = unnamed_values(20)
+    for value in values:
+        value.name = value.thing
+    questions = generate.random_questions(values, set(), 30)
+    path = tmp_path / "questions.json"
+    with open(path, "w") as file:
+        cli.save_questions(questions, file, normalized=True)
+    assert cli.is_normalized(str(path))
+    loaded = cli.load_questions(str(path))
+    assert [q.serialize() for q in loaded] == [q.serialize() for q in questions]
+    table = json.loads(path.read_text())["values"]
+    used = {id(value) for q in questions for value in q.values}
+    assert len({id(value) for q in loaded for value in q.values}) == len(table)
+    assert len(table) == len(used)
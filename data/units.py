@@ -1,10 +1,12 @@
 from __future__ import annotations
-from typing import Dict, List
+from typing import Dict, List, Tuple
 from dataclasses import InitVar, dataclass, field, asdict
+from decimal import Decimal
 import re
 from math import prod, log10, floor
 from copy import copy, deepcopy
 from collections import defaultdict
+from functools import cached_property, lru_cache
 
 number_regex = r"-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?"
 
@@ -24,7 +26,7 @@ prefixes = {
 prefixes_by_magnitude = {val: key for key, val in prefixes.items()}
 
 
-@dataclass
+@dataclass(frozen=True)
 class Unit:
     name: str
     power: int = 1
@@ -63,12 +65,19 @@ class Unit:
 
 
 def scientific(num: float, precision: int = None):
-    magnitude = floor(log10(num))
     if precision != None:
+        magnitude = floor(log10(num))
         num *= 10 ** (precision - magnitude - 1)
         num = round(num) / 10 ** (precision - 1)
         return f"{num}e{magnitude}"
-    return f"{num / 10**magnitude}e{magnitude}"
+    if num == 0:
+        return "0.0e0"
+    # moves the point in the shortest digits that read back as num, so
+    # writing and reading a quantity gives back the same number
+    sign, digits, exponent = Decimal(repr(num)).as_tuple()
+    magnitude = len(digits) + exponent - 1
+    rest = "".join(map(str, digits[1:])).rstrip("0") or "0"
+    return f"{'-' if sign else ''}{digits[0]}.{rest}e{magnitude}"
 
 
 def combine_units(preferred_units):
@@ -78,12 +87,17 @@ def combine_units(preferred_units):
     return (prod(ratios), sum(magnitudes), units)
 
 
-@dataclass
+@dataclass(frozen=True)
 class Units:
-    units: List[Unit]
+    units: Tuple[Unit, ...]
+
+    def __post_init__(self):
+        # Units are shared between quantities (see parse_units), so they are
+        # stored as an immutable tuple
+        object.__setattr__(self, "units", tuple(self.units))
 
     @staticmethod
-    def parse(string: str, known: ConversionMap) -> List[Unit]:
+    def parse(string: str, known: ConversionMap) -> Units:
         string = string.replace("^", "")
         positive, _, negative = string.partition("/")
 
@@ -92,28 +106,30 @@ class Units:
             return [Unit._parse(s, known) for s in unit_strings]
 
         positive = helper(positive)
-        negative = helper(negative)
-        for unit in negative:
-            unit.power *= -1
+        negative = [unit**-1 for unit in helper(negative)]
         return Units(positive + negative)
 
     def mul(self, units: Units):
-        units = Units(self.units + units.units)
-        units.simplify()
-        return units
+        return Units(self.units + units.units).simplify()
 
     def simplify(self):
         units = defaultdict(int)
         for unit in self.units:
             units[(unit.name, unit.magnitude)] += unit.power
-        self.units = [
-            Unit(name, power, magnitude)
-            for (name, magnitude), power in units.items()
-            if power != 0
-        ]
+        return Units(
+            [
+                Unit(name, power, magnitude)
+                for (name, magnitude), power in units.items()
+                if power != 0
+            ]
+        )
 
     def sort(self):
-        self.units.sort(key=lambda x: (x.power, x.name, x.magnitude))
+        return Units(sorted(self.units, key=lambda x: (x.power, x.name, x.magnitude)))
+
+    @cached_property
+    def dimension(self) -> Dimension:
+        return Dimension.from_units(self)
 
     def single(self):
         return (
@@ -140,9 +156,7 @@ class Units:
         negative = []
         if neg_index != None:
             positive = units[:neg_index]
-            negative = deepcopy(units[neg_index:])
-            for unit in negative:
-                unit.power *= -1
+            negative = [unit**-1 for unit in units[neg_index:]]
         positive = [str(unit) for unit in positive]
         negative = [str(unit) for unit in negative]
         string = "".join(positive)
@@ -154,6 +168,113 @@ class Units:
         return self.units.__iter__()
 
 
+class Dimension:
+    """
+    Units as a vector of exponents over base_units, the exponents of any other
+    units by name, and a power of ten scale. Trailing zero exponents are
+    dropped, so equal units are always equal vectors and compare by hash.
+    """
+
+    __slots__ = ("exponents", "others", "scale", "_hash")
+
+    def __init__(
+        self,
+        exponents: Tuple[int, ...] = (),
+        scale: int = 0,
+        others: Tuple[Tuple[str, int], ...] = (),
+    ):
+        exponents = list(exponents)
+        while exponents and not exponents[-1]:
+            exponents.pop()
+        self.exponents = tuple(exponents)
+        self.others = tuple(sorted((name, power) for name, power in others if power))
+        self.scale = scale
+        self._hash = hash((self.exponents, self.others, scale))
+
+    def __reduce__(self):
+        # string hashes differ between processes, so the hash is worked out
+        # again instead of being pickled
+        return (Dimension, (self.exponents, self.scale, self.others))
+
+    @staticmethod
+    def from_units(units: Units) -> Dimension:
+        exponents = [0] * len(base_units)
+        others = defaultdict(int)
+        scale = 0
+        for unit in units:
+            index = base_unit_indices.get(unit.name)
+            if index is None:
+                others[unit.name] += unit.power
+            else:
+                exponents[index] += unit.power
+            scale += unit.magnitude * unit.power
+        return Dimension(exponents, scale, others.items())
+
+    def to_units(self) -> Units:
+        units = [
+            Unit(base_units[index], power)
+            for index, power in enumerate(self.exponents)
+            if power
+        ]
+        units += [Unit(name, power) for name, power in self.others]
+        if not self.scale:
+            return Units(units)
+        for i, unit in enumerate(units):
+            magnitude, rest = divmod(self.scale, unit.power)
+            if not rest and magnitude in prefixes_by_magnitude:
+                units[i] = Unit(unit.name, unit.power, magnitude)
+                return Units(units)
+        raise ValueError(f"Cannot express a scale of 1e{self.scale} with a prefix")
+
+    def mul(self, other: Dimension):
+        length = max(len(self.exponents), len(other.exponents))
+        a = self.exponents + (0,) * (length - len(self.exponents))
+        b = other.exponents + (0,) * (length - len(other.exponents))
+        others = defaultdict(int, self.others)
+        for name, power in other.others:
+            others[name] += power
+        return Dimension(
+            tuple(x + y for x, y in zip(a, b)),
+            self.scale + other.scale,
+            others.items(),
+        )
+
+    def __mul__(self, other):
+        return self.mul(other)
+
+    def __truediv__(self, other):
+        return self.mul(other**-1)
+
+    def __pow__(self, power: int):
+        return Dimension(
+            tuple(exponent * power for exponent in self.exponents),
+            self.scale * power,
+            tuple((name, exponent * power) for name, exponent in self.others),
+        )
+
+    def __eq__(self, other):
+        return (
+            type(other) == Dimension
+            and self._hash == other._hash
+            and self.exponents == other.exponents
+            and self.others == other.others
+            and self.scale == other.scale
+        )
+
+    def __hash__(self):
+        return self._hash
+
+    def __str__(self):
+        try:
+            return str(self.to_units())
+        except ValueError:
+            units = Dimension(self.exponents, 0, self.others).to_units()
+            return f"1e{self.scale} {units}".strip()
+
+    def __repr__(self):
+        return f"Dimension({self.exponents}, {self.scale}, {self.others})"
+
+
 @dataclass
 class Conversion:
     from_name: str
@@ -170,7 +291,7 @@ class Conversion:
         )
 
 
-@dataclass
+@dataclass(slots=True)
 class Quantity:
     value: float
     units: Units = field(default_factory=lambda: Units([]))
@@ -183,8 +304,7 @@ class Quantity:
         if not match:
             print(f"Could not parse quantity '{string}'")
         number, units = match.group(1, 2)
-        units = Units.parse(units, preferred)
-        return Quantity(float(number or "1"), units)
+        return Quantity(float(number or "1"), parse_units(units))
 
     @staticmethod
     def deserialize(string: str):
@@ -194,34 +314,11 @@ class Quantity:
         return self.value
 
     def standardized(self, map: ConversionMap, limit=100):
-        res = deepcopy(self)
-        for i in range(0, limit):
-            single = res.units.single()
-            if single and single in map:
-                conversion = map[single]
-                if type(conversion) == Conversion:
-                    res = conversion.convert(res)
-                    continue
-            simplifier = Quantity(1)
-            for unit in res.units:
-                name = unit.name
-                if unit.magnitude:
-                    simplifier *= Quantity(
-                        10 ** (unit.magnitude * unit.power),
-                        Units([unit.magnitudeless(), unit**-1]),
-                    )
-                elif name in map and map[name] and type(map[name]) == Quantity:
-                    simplifier *= map[name] ** unit.power
-            if len(simplifier.units):
-                res *= simplifier
-            else:
-                break
-        if i == 100:
-            raise ValueError("AAAH")
-        return res
+        value, units = conversion_table(map, limit).convert(self.value, self.units)
+        return Quantity(value, units)
 
     def close(self, other, eps=1e-5):
-        if self.units != other.units:
+        if self.units.dimension != other.units.dimension:
             return False
         if self.value * other.value < 0:
             return False
@@ -266,6 +363,20 @@ class Quantity:
         return self.to_string()
 
 
+@lru_cache(maxsize=None)
+def parse_units(string: str) -> Units:
+    """
+    Parse a unit string against the preferred units, once per distinct string.
+    The returned Units are immutable and shared between every caller.
+    """
+    return Units.parse(string, preferred)
+
+
+def parse_cache_info():
+    """Hit/miss counters of the unit string cache"""
+    return parse_units.cache_info()
+
+
 def canonicalize_quantity_map(unit, quantity) -> Quantity:
     if not quantity:
         return
@@ -278,6 +389,104 @@ def canonicalize_quantity_map(unit, quantity) -> Quantity:
 
 ConversionMap = Dict[str, Quantity | Conversion | None]
 
+
+def conversion_table(map: ConversionMap, limit=100) -> ConversionTable:
+    if map is preferred:
+        return preferred_table
+    return ConversionTable(map, limit)
+
+
+class ConversionTable:
+    """
+    A conversion map flattened so that every known unit (with every prefix)
+    maps straight to a factor, a power of ten and its base units
+    """
+
+    def __init__(self, map: ConversionMap, limit=100):
+        self.map = map
+        self.limit = limit
+        self.affine: Dict[str, Conversion] = {
+            name: conversion
+            for name, conversion in map.items()
+            if type(conversion) == Conversion
+        }
+        self.table: Dict[Tuple[str, int], Tuple[float, int, Units] | None] = {}
+        self.compiled: Dict[Units, Tuple[float, int, Units]] = {}
+        for name in map:
+            for magnitude in [0, *prefixes.values()]:
+                self.resolve(name, magnitude)
+
+    def resolve(self, name: str, magnitude: int = 0, depth: int = 0):
+        """
+        Return (factor, exponent, units) such that one of the unit equals
+        factor * 10**exponent units, or None if it is already a base unit
+        """
+        key = (name, magnitude)
+        if key in self.table:
+            return self.table[key]
+        if depth > self.limit:
+            raise ValueError(f"Conversion of '{name}' does not terminate")
+        conversion = self.map.get(name)
+        if type(conversion) != Quantity:
+            entry = (1.0, magnitude, Units([Unit(name)])) if magnitude else None
+        else:
+            factor, exponent, units = conversion.value, magnitude, []
+            for unit in (conversion * Unit(name)).units:
+                resolved = self.resolve(unit.name, unit.magnitude, depth + 1)
+                if resolved is None:
+                    units.append(unit)
+                    continue
+                unit_factor, unit_exponent, unit_units = resolved
+                factor *= unit_factor**unit.power
+                exponent += unit_exponent * unit.power
+                units.extend(unit_units**unit.power)
+            entry = (factor, exponent, Units(units).simplify())
+        self.table[key] = entry
+        return entry
+
+    def convert(self, value, units: Units):
+        """
+        Convert a magnitude (a float or a numpy array) in the given units to
+        base units, returning the new magnitude and units
+        """
+        # temperatures are affine, so they only convert when on their own
+        for _ in range(self.limit):
+            conversion = self.affine.get(units.single())
+            if not conversion:
+                break
+            value = (value + conversion.offset) * conversion.ratio
+            units = Units([Unit(conversion.to_name)])
+        compiled = self.compiled.get(units)
+        if compiled is None:
+            compiled = self.compile(units)
+        factor, exponent, units = compiled
+        if exponent:
+            value = value * 10**exponent
+        if factor != 1:
+            value = value * factor
+        return value, units
+
+    def compile(self, units: Units):
+        """Combine the table entries of every unit of a (non-affine) Units"""
+        factor, exponent = 1.0, 0
+        base, converted = [], []
+        for unit in units:
+            resolved = self.resolve(unit.name, unit.magnitude)
+            if resolved is None:
+                base.append(unit)
+                continue
+            unit_factor, unit_exponent, unit_units = resolved
+            factor *= unit_factor**unit.power
+            exponent += unit_exponent * unit.power
+            converted.extend(unit_units**unit.power)
+        if converted or exponent:
+            compiled = (factor, exponent, Units(base + converted).simplify())
+        else:
+            compiled = (factor, exponent, units)
+        self.compiled[units] = compiled
+        return compiled
+
+
 preferred = {
     "g": None,
     "m": None,
@@ -319,6 +528,17 @@ preferred = {
     for unit, quantity in preferred.items()
 }
 
+preferred_table = ConversionTable(preferred)
+
+# The axes of Dimension vectors. Other units are kept by name (see Dimension).
+base_units: List[str] = [unit for unit, quantity in preferred.items() if not quantity]
+base_units += [
+    quantity.to_name
+    for quantity in preferred.values()
+    if type(quantity) == Conversion and quantity.to_name not in preferred
+]
+base_unit_indices = {unit: i for i, unit in enumerate(base_units)}
+
 
 def test(value1: str, value2: str = "1"):
     quant1 = Quantity.from_str(value1)
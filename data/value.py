@@ -1,12 +1,12 @@
 from __future__ import annotations
 from dataclasses import dataclass, field, asdict
 from typing import Dict, List, Callable
-from data import default, now
+from data import default, intern, now
 
 from units import Units, Quantity
 
 
-@dataclass
+@dataclass(slots=True)
 class Value:
     value: Quantity
     name: str = ""  # ie max depth of the Pacific Ocean, population of the US, etc
@@ -18,9 +18,19 @@ class Value:
     quality: float = 0.0
     generated: str = default(now)
     image: str = ""
+    tags: List[str] = default(list)  # the thing's tags
+
+    def __post_init__(self):
+        # these repeat across the values of a thing, or of every thing
+        self.measurement = intern(self.measurement)
+        self.thing = intern(self.thing)
+        self.specifier = intern(self.specifier)
+        self.note = intern(self.note)
+        self.generated = intern(self.generated)
+        self.image = intern(self.image)
 
     def serialize(self):
-        return {
+        data = {
             "value": self.value.serialize(),
             "name": self.name,
             "measurement": self.measurement,
@@ -31,6 +41,10 @@ class Value:
             "generated": self.generated,
             "image": self.image,
         }
+        # kept so naming rules and examples can use them without the sheet
+        if self.tags:
+            data["tags"] = self.tags
+        return data
 
     @staticmethod
     def deserialize(data: Dict):
@@ -57,7 +71,7 @@ class Value:
         return messages
 
 
-@dataclass
+@dataclass(slots=True)
 class Thing:
     name: str  # ie Eiffel tower, Pacific ocean
     tags: List[str]  # ie sphere, building
@@ -79,6 +93,7 @@ class Thing:
             extra = fn(self) or []
             for value in extra:
                 value.thing = self.name
+                value.tags = self.tags
                 if value.measurement in self.values:
                     self.values[value.measurement].append(value)
                 else: